@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+"""
+Local stand-ins of Twitter and Telegram for benchmarks:
+a GraphQL TweetResultByRestId responder, a media CDN serving sized files, and a Bot API.
+"""
+
+import asyncio
+import json
+import re
+import socket
+import time
+from collections import defaultdict
+
+import uvicorn
+from quart import Quart, Response, request, jsonify
+
+CHUNK_SIZE = 64 * 1024
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+async def serve(app: Quart, port: int) -> uvicorn.Server:
+    """
+    Serve app on 127.0.0.1:port in the running loop, set server.should_exit to stop it
+    """
+    server = uvicorn.Server(uvicorn.Config(app, host='127.0.0.1', port=port, log_level='warning'))
+    server.task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    return server
+
+
+def graphql_app(tweets: dict, cdn_url: str, latency: float = 0.0) -> Quart:
+    """
+    :param tweets: tweet id -> (number of photos, number of videos, image size, video size)
+    :param cdn_url: base url of the media CDN
+    :param latency: seconds before each response
+    """
+    app = Quart('fake_graphql')
+
+    @app.get('/i/api/graphql/<qid>/<name>')
+    async def tweet_result(qid: str, name: str):
+        await asyncio.sleep(latency)
+        tweet_id = str(json.loads(request.args.get('variables', '{}')).get('tweetId', ''))
+        if tweet_id not in tweets:
+            return jsonify({'data': {'tweetResult': {}}})
+
+        photos, videos, image_size, video_size = tweets[tweet_id]
+        media = []
+        for i in range(photos):
+            media.append({'type': 'photo', 'url': 'https://t.co/bench',
+                          'media_url_https': f'{cdn_url}/media/{image_size}/{tweet_id}_{i}.jpg'})
+        for i in range(videos):
+            # bitrate x duration matches the size, so the client picks it without probing
+            variants = [{'bitrate': size * 8 // 10, 'content_type': 'video/mp4',
+                         'url': f'{cdn_url}/media/{size}/{tweet_id}_{i}_{size}.mp4'}
+                        for size in (video_size, video_size // 4)]
+            media.append({'type': 'video', 'url': 'https://t.co/bench',
+                          'video_info': {'duration_millis': 10000, 'variants': variants}})
+
+        legacy = {'full_text': f'Benchmark tweet {tweet_id} https://t.co/bench'}
+        if media:
+            legacy['extended_entities'] = {'media': media}
+        result = {'__typename': 'Tweet', 'rest_id': tweet_id, 'legacy': legacy,
+                  'core': {'user_results': {'result': {'legacy': {'name': 'Bench', 'screen_name': 'bench'}}}}}
+        return jsonify({'data': {'tweetResult': {'result': result}}})
+
+    return app
+
+
+def cdn_app(latency: float = 0.0, ranges: bool = True) -> Quart:
+    """
+    Serve /media/<size>/<name> with size bytes, after latency seconds
+    :param ranges: answer Range requests with 206, otherwise always send the whole media without Accept-Ranges
+    """
+    app = Quart('fake_cdn')
+    app.stats = {'requests': 0, 'bytes': 0, 'range_requests': 0}
+
+    @app.route('/media/<int:size>/<name>', methods=['GET', 'HEAD'])
+    async def media(size: int, name: str):
+        await asyncio.sleep(latency)
+        app.stats['requests'] += 1
+        status, start, end = 200, 0, size - 1
+        headers = {'Content-Type': 'application/octet-stream'}
+        match = re.match(r'^bytes=(\d+)-(\d*)$', request.headers.get('Range', ''))
+        if ranges:
+            headers['Accept-Ranges'] = 'bytes'
+            if match and int(match.group(1)) < size:
+                app.stats['range_requests'] += 1
+                status, start = 206, int(match.group(1))
+                end = min(int(match.group(2) or size - 1), size - 1)
+                headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+        length = end - start + 1
+        headers['Content-Length'] = str(length)
+        if request.method == 'HEAD':
+            # a bytes body would reset Content-Length to 0, the server drops the body of HEAD responses
+            return Response(iter(()), status=status, headers=headers)
+
+        async def body():
+            sent = 0
+            chunk = b'\0' * CHUNK_SIZE
+            while sent < length:
+                part = chunk[:min(CHUNK_SIZE, length - sent)]
+                sent += len(part)
+                app.stats['bytes'] += len(part)
+                yield part
+
+        return Response(body(), status=status, headers=headers)
+
+    return app
+
+
+def bot_api_app() -> Quart:
+    """
+    Accept Bot API calls, app.replies records the time of each reply by chat id,
+    app.reply_events[chat_id] is set on the first reply of a chat.
+    """
+    app = Quart('fake_bot_api')
+    app.config['MAX_CONTENT_LENGTH'] = None     # uploads of up to 50MB media groups
+    app.replies = defaultdict(list)
+    app.reply_events = defaultdict(asyncio.Event)
+    app.stats = {'requests': 0, 'uploaded_bytes': 0}
+    counter = {'message_id': 0, 'file_id': 0}
+
+    def message(chat_id, **kwargs) -> dict:
+        counter['message_id'] += 1
+        return {'message_id': counter['message_id'], 'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'}} | kwargs
+
+    def file(**kwargs) -> dict:
+        counter['file_id'] += 1
+        return {'file_id': f'file{counter["file_id"]}', 'file_unique_id': f'unique{counter["file_id"]}'} | kwargs
+
+    def reply(chat_id):
+        app.replies[chat_id].append(time.perf_counter())
+        app.reply_events[chat_id].set()
+
+    @app.route('/bot<token>/<method>', methods=['GET', 'POST'])
+    async def api(token: str, method: str):
+        app.stats['requests'] += 1
+        app.stats['uploaded_bytes'] += request.content_length or 0
+        form = await request.form
+        chat_id = int(form.get('chat_id', 0) or 0)
+
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        elif method == 'sendMessage':
+            result = message(chat_id, text=form.get('text', ''))
+            reply(chat_id)
+        elif method == 'sendMediaGroup':
+            result = []
+            for item in json.loads(form.get('media', '[]')):
+                if item.get('type') == 'video':
+                    result.append(message(chat_id, video=file(width=1280, height=720, duration=10)))
+                elif item.get('type') == 'photo':
+                    result.append(message(chat_id, photo=[file(width=1280, height=720)]))
+                else:
+                    result.append(message(chat_id, document=file()))
+            reply(chat_id)
+        elif method == 'getWebhookInfo':
+            result = {'url': '', 'has_custom_certificate': False, 'pending_update_count': 0}
+        else:
+            result = True
+
+        return jsonify({'ok': True, 'result': result})
+
+    return app
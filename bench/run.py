@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+End-to-end benchmark of TelegramBot and TwitterClient against local fake Twitter and Telegram servers.
+
+    python -m bench.run
+    python -m bench.run --mix photos video --concurrency 1 16 --tweets 200 --max-p99 5
+
+Every scenario (media mix x concurrency) runs in its own process, so peak RSS is per scenario.
+Exit code is 1 if a scenario is slower than --max-p99 or --min-throughput, to gate performance regressions.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+# number of photos and videos of each tweet
+MIXES = {'text': (0, 0), 'photo': (1, 0), 'photos': (4, 0), 'video': (0, 1), 'mixed': (2, 1)}
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mix', nargs='+', choices=MIXES, default=list(MIXES), help='media mixes to run')
+    parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 8, 32], help='updates in flight')
+    parser.add_argument('--tweets', type=int, default=100, help='updates per scenario')
+    parser.add_argument('--distinct', type=int, default=0, help='distinct tweets per scenario, 0 for all distinct')
+    parser.add_argument('--image-size', type=int, default=512 * 1024, help='bytes of each photo')
+    parser.add_argument('--video-size', type=int, default=8 * 1024**2, help='bytes of each video')
+    parser.add_argument('--cdn-latency', type=float, default=0.05, help='seconds before each CDN response')
+    parser.add_argument('--graphql-latency', type=float, default=0.2, help='seconds before each GraphQL response')
+    parser.add_argument('--no-ranges', action='store_true', help='CDN without Range support')
+    parser.add_argument('--timeout', type=float, default=120, help='seconds to wait for the reply of an update')
+    parser.add_argument('--max-p99', type=float, default=0, help='fail if p99 latency is higher, in seconds')
+    parser.add_argument('--min-throughput', type=float, default=0, help='fail if tweets/sec is lower')
+    parser.add_argument('--json', action='store_true', help='print results as json lines')
+    parser.add_argument('--single', action='store_true', help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+async def run_scenario(args, mix: str) -> dict:
+    from bench.fake_servers import free_port, serve, graphql_app, cdn_app, bot_api_app
+
+    concurrency = args.concurrency[0]
+    photos, videos = MIXES[mix]
+    distinct = args.distinct or args.tweets
+    tweets = {str(10**18 + i): (photos, videos, args.image_size, args.video_size) for i in range(distinct)}
+
+    cdn_port, graphql_port, bot_api_port = free_port(), free_port(), free_port()
+    cdn = cdn_app(args.cdn_latency, ranges=not args.no_ranges)
+    bot_api = bot_api_app()
+    servers = [await serve(cdn, cdn_port),
+               await serve(graphql_app(tweets, f'http://127.0.0.1:{cdn_port}', args.graphql_latency), graphql_port),
+               await serve(bot_api, bot_api_port)]
+
+    os.environ.update({
+        'TOKEN': '123456:bench',
+        'TELEGRAM_API_URL': f'http://127.0.0.1:{bot_api_port}/bot',
+        'ASYNC_GRAPHQL': 'True',
+        'TWITTER_GRAPHQL_URL': f'http://127.0.0.1:{graphql_port}/i/api/graphql',
+        'TWITTER_COOKIE': '{"auth_token": "bench", "ct0": "bench"}',
+        'TWITTER_USERNAME': '',
+        'TWITTER_GUEST_SESSIONS': '0',
+        'WEB_URL_ENABLE': 'False',
+    })
+    from telebot.bot import TelegramBot
+    from telegram import Update
+
+    bot = TelegramBot()
+    await bot.application.initialize()
+    await bot.application.start()
+
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, failures = [], 0
+
+    async def one(i: int):
+        nonlocal failures
+        chat_id = i + 1
+        tweet_id = list(tweets)[i % distinct]
+        message = {'message_id': i + 1, 'date': int(time.time()), 'text': f'https://x.com/bench/status/{tweet_id}',
+                   'chat': {'id': chat_id, 'type': 'private'},
+                   'from': {'id': chat_id, 'is_bot': False, 'first_name': 'bench'}}
+        async with semaphore:
+            start = time.perf_counter()
+            await bot.application.update_queue.put(Update.de_json({'update_id': i + 1, 'message': message},
+                                                                   bot.application.bot))
+            try:
+                await asyncio.wait_for(bot_api.reply_events[chat_id].wait(), args.timeout)
+            except asyncio.TimeoutError:
+                failures += 1
+                return
+            latencies.append(bot_api.replies[chat_id][0] - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one(i) for i in range(args.tweets)])
+    elapsed = time.perf_counter() - start
+
+    await bot.application.stop()
+    await bot.application.shutdown()
+    for server in servers:
+        server.should_exit = True
+    await asyncio.gather(*[server.task for server in servers], return_exceptions=True)
+
+    return {'mix': mix, 'concurrency': concurrency, 'tweets': args.tweets, 'failures': failures,
+            'throughput': round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+            'p50': round(percentile(latencies, 0.5), 3), 'p99': round(percentile(latencies, 0.99), 3),
+            'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            'downloaded_mb': round(cdn.stats['bytes'] / 1024**2, 1),
+            'uploaded_mb': round(bot_api.stats['uploaded_bytes'] / 1024**2, 1)}
+
+
+def run_single(args):
+    sys.path.insert(0, ROOT)
+    os.chdir(tempfile.mkdtemp(prefix='twigram-bench-'))    # temp/ of TwitterClient goes here
+    result = asyncio.run(run_scenario(args, args.mix[0]))
+    print(json.dumps(result))
+
+
+def main():
+    args = parse_args()
+    if args.single:
+        return run_single(args)
+
+    results, failed = [], False
+    for mix in args.mix:
+        for concurrency in args.concurrency:
+            command = [sys.executable, '-m', 'bench.run', '--single', '--mix', mix, '--concurrency', str(concurrency),
+                       '--tweets', str(args.tweets), '--distinct', str(args.distinct),
+                       '--image-size', str(args.image_size), '--video-size', str(args.video_size),
+                       '--cdn-latency', str(args.cdn_latency), '--graphql-latency', str(args.graphql_latency),
+                       '--timeout', str(args.timeout)] + (['--no-ranges'] if args.no_ranges else [])
+            env = os.environ | {'PYTHONPATH': ROOT}
+            proc = subprocess.run(command, cwd=ROOT, env=env, capture_output=True, text=True)
+            if proc.returncode != 0:
+                print(f'{mix} x {concurrency} failed:\n{proc.stderr}', file=sys.stderr)
+                failed = True
+                continue
+
+            result = json.loads(proc.stdout.strip().splitlines()[-1])
+            results.append(result)
+            if (args.max_p99 and result['p99'] > args.max_p99) or result['failures'] \
+                    or (args.min_throughput and result['throughput'] < args.min_throughput):
+                result['regression'] = True
+                failed = True
+
+            if args.json:
+                print(json.dumps(result), flush=True)
+            else:
+                print('{mix:>7} x {concurrency:<3} {throughput:>8} tweets/s  p50 {p50:>7}s  p99 {p99:>7}s  '
+                      'rss {peak_rss_mb:>7}MB  failures {failures}{flag}'
+                      .format(**result, flag='  REGRESSION' if result.get('regression') else ''), flush=True)
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    Bounded in-memory cache with per-entry TTL and LRU eviction.
+    Not thread safe, it is meant to be used from the event loop only.
+    With a shared store, entries are also written to the store, and fetch() looks up local misses there,
+    so all worker processes share the cache. Values must be json serializable then.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 600, store=None, namespace: str = ''):
+        """
+        :param maxsize:
+        :param ttl: seconds
+        :param store: lib.store.SharedStore, or None
+        :param namespace: namespace of the entries in the store
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.store = store
+        self.namespace = namespace
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # key -> (expire_at, value)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, count=False) is not None
+
+    def get(self, key, default=None, count: bool = True):
+        """
+        Get value of key from memory, move it to the end of LRU order, the shared store is not looked up
+        :param key:
+        :param default: returned when key is missing or expired
+        :param count: update hit/miss counters
+        :return:
+        """
+        value = self._get_local(key)
+        if count:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return default if value is None else value
+
+    async def fetch(self, key, default=None, count: bool = True):
+        """
+        Get value of key like get(), a local miss is looked up in the shared store
+        :param key:
+        :param default: returned when key is missing or expired
+        :param count: update hit/miss counters
+        :return:
+        """
+        value = self._get_local(key)
+        if value is None and self.store is not None and self.maxsize > 0:
+            entry = await self.store.get_with_ttl(self.namespace, key)
+            if entry is not None:
+                value, ttl = entry
+                self._set_local(key, value, ttl)
+
+        if count:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return default if value is None else value
+
+    def _get_local(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        expire_at, value = item
+        if expire_at <= time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl: float = None):
+        """
+        Set value of key, evict the least recently used entries if the cache is full
+        :param key:
+        :param value:
+        :param ttl: override the default TTL for this entry
+        :return:
+        """
+        if self.maxsize <= 0:
+            return
+
+        ttl = self.ttl if ttl is None else ttl
+        self._set_local(key, value, ttl)
+        if self.store is not None:
+            self.store.set(self.namespace, key, value, ttl)
+
+    def _set_local(self, key, value, ttl: float):
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        if self.store is not None:
+            self.store.delete(self.namespace, key)
+        item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def clear(self):
+        self._data.clear()
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> dict:
+        return {'size': len(self._data), 'maxsize': self.maxsize, 'hits': self.hits,
+                'misses': self.misses, 'hit_ratio': round(self.hit_ratio, 4)}
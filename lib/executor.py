@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class InstrumentedExecutor(ThreadPoolExecutor):
+    """
+    ThreadPoolExecutor which counts queued and running jobs, and the time jobs wait in the queue
+    """
+
+    def __init__(self, max_workers: int = None, thread_name_prefix: str = ''):
+        super().__init__(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+        self._stats_lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.max_queued = 0
+        self.wait_time = 0.0    # total seconds jobs waited in the queue
+
+    def submit(self, fn, /, *args, **kwargs):
+        submitted_at = time.monotonic()
+        with self._stats_lock:
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+
+        def run():
+            with self._stats_lock:
+                self.queued -= 1
+                self.running += 1
+                self.wait_time += time.monotonic() - submitted_at
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._stats_lock:
+                    self.running -= 1
+                    self.completed += 1
+
+        return super().submit(run)
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {'workers': self._max_workers, 'queued': self.queued, 'running': self.running,
+                    'completed': self.completed, 'max_queued': self.max_queued,
+                    'avg_wait': round(self.wait_time / self.completed, 4) if self.completed else 0.0}
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+
+import fcntl
+import hashlib
+import os
+import re
+import shutil
+import uuid
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+from lib.logger import logger
+from lib.utils import run_io
+
+# <media key>_<original name>, the media key is a hash of the media url
+_name_pattern = re.compile(r'^([0-9a-f]{24})_(.+)$')
+
+
+def original_name(path: str) -> str:
+    """
+    :param path: path of a file in the media store
+    :return: original file name of the media, e.g. 'F1abc.jpg'
+    """
+    name = os.path.basename(path)
+    match = _name_pattern.match(name)
+    return match.group(2) if match else name
+
+
+def is_locked(path: str) -> bool:
+    """
+    :param path: lock file
+    :return: True if a live process holds the lock
+    """
+    try:
+        with open(path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return True
+    except OSError:
+        pass
+    return False
+
+
+def remove_file(path: str):
+    """
+    Remove a file if it exists
+    """
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class MediaStore:
+    """
+    Downloaded media in a directory, keyed by media url, with a disk quota and LRU eviction.
+    A media requested again is reused instead of downloaded again. Files in use are pinned and never evicted.
+    Files are written to a .part file and renamed when complete, so a crash never leaves a truncated media,
+    orphaned files are swept at startup.
+    The index and the pins are per process, so each worker process has its own subdirectory <directory>/<pid>,
+    and workers never evict each other's media. A worker holds the lock file of its subdirectory while it runs.
+    At startup, it adopts the subdirectory of a dead worker, so the media of the previous run are reused,
+    and removes the other ones of dead workers and any loose file in the directory.
+    """
+
+    lock_name = '.lock'
+
+    def __init__(self, directory: str, quota: int = 512 * 1024**2):
+        self.root = directory
+        os.makedirs(directory, exist_ok=True)
+        self.directory = self._claim_directory()
+        self._lock_file = open(os.path.join(self.directory, self.lock_name), 'a')
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        self.quota = quota
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self._files = OrderedDict()     # path -> size, in LRU order
+        self._pins = {}                 # path -> number of users
+
+        self.sweep()
+
+    def _claim_directory(self) -> str:
+        """
+        Clean up the directory of the store, media of dead workers are adopted once, the rest is removed
+        :return: subdirectory of this process
+        """
+        own = os.path.join(self.root, str(os.getpid()))
+        adopted = os.path.isdir(own)    # left by a dead process with the same pid
+        for entry in os.scandir(self.root):
+            try:
+                if not entry.is_dir(follow_symlinks=False):
+                    os.remove(entry.path)   # leftover of the layout without subdirectories
+                    logger.info(f'Orphaned media file removed: {entry.path}')
+                    continue
+                if entry.path == own:
+                    continue
+                if entry.name.endswith('.trash'):
+                    shutil.rmtree(entry.path, ignore_errors=True)   # a removal was interrupted
+                    continue
+                if is_locked(os.path.join(entry.path, self.lock_name)):
+                    continue    # a live worker
+
+                # renaming claims it, another worker starting at the same time can't adopt or remove it then
+                target = own if not adopted else f'{entry.path}.{uuid.uuid4().hex[:8]}.trash'
+                os.rename(entry.path, target)
+            except OSError:
+                continue    # claimed by another worker
+            if target == own:
+                adopted = True
+                logger.info(f'Media store {entry.path} of a dead worker adopted as {own}')
+            else:
+                shutil.rmtree(target, ignore_errors=True)
+                logger.info(f'Media store {entry.path} of a dead worker removed')
+        os.makedirs(own, exist_ok=True)
+        return own
+
+    def sweep(self):
+        """
+        Index the media left by previous runs, remove orphaned and partial files
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_file() or entry.name == self.lock_name:
+                continue
+            try:
+                stat = entry.stat()
+                if _name_pattern.match(entry.name) and not entry.name.endswith('.part'):
+                    entries.append((stat.st_mtime, entry.path, stat.st_size))
+                else:
+                    # .part files are left by a crash, nobody else writes to this directory
+                    os.remove(entry.path)
+                    logger.info(f'Orphaned media file removed: {entry.path}')
+            except OSError as e:
+                logger.error(f'Failed to sweep media file {entry.path}: {e}')
+
+        for _, path, size in sorted(entries):
+            self._files[path] = size
+            self.size += size
+        logger.info(f'Media store {self.directory}: {len(self._files)} files, {self.size} bytes')
+
+    def path_for(self, url: str) -> str:
+        """
+        :param url: media url
+        :return: path of the media in the store
+        """
+        key = hashlib.sha256(url.encode()).hexdigest()[:24]
+        name = urlparse(url).path.split('/')[-1] or 'media'
+        return os.path.join(self.directory, f'{key}_{name}')
+
+    @staticmethod
+    def part_path(path: str) -> str:
+        """
+        :return: unique temporary path to write the media, rename it to path with commit()
+        """
+        return f'{path}.{uuid.uuid4().hex[:8]}.part'
+
+    async def get(self, url: str) -> str | None:
+        """
+        Get a stored media and pin it, unpin() it after use
+        :param url:
+        :return: path, or None if it's not stored
+        """
+        path = self.path_for(url)
+        if path in self._files and not await run_io(os.path.isfile, path):
+            # removed behind our back, e.g. by hand
+            self.size -= self._files.pop(path)
+        if path not in self._files:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._files.move_to_end(path)
+        self.pin(path)
+        return path
+
+    async def commit(self, part: str, path: str) -> str:
+        """
+        Move a completely written part file to its path, pin it, and evict old media over the quota
+        :param part:
+        :param path:
+        :return: path
+        """
+        await run_io(os.replace, part, path)
+        size = await run_io(os.path.getsize, path)
+        self.size += size - self._files.pop(path, 0)
+        self._files[path] = size
+        self.pin(path)
+        await self.evict()
+        return path
+
+    def pin(self, path: str):
+        self._pins[path] = self._pins.get(path, 0) + 1
+
+    async def unpin(self, path: str):
+        count = self._pins.get(path, 0) - 1
+        if count > 0:
+            self._pins[path] = count
+        else:
+            self._pins.pop(path, None)
+            await self.evict()
+
+    async def evict(self):
+        """
+        Remove the least recently used media which are not pinned, until the store is under the quota
+        """
+        if self.size <= self.quota:
+            return
+
+        for path in list(self._files):
+            if self.size <= self.quota:
+                break
+            if path in self._pins:
+                continue
+            size = self._files.pop(path)
+            self.size -= size
+            self.evicted += 1
+            try:
+                await run_io(remove_file, path)
+            except OSError as e:
+                logger.error(f'Failed to evict media file {path}: {e}')
+
+    def stats(self) -> dict:
+        return {'files': len(self._files), 'size': self.size, 'quota': self.quota, 'pinned': len(self._pins),
+                'hits': self.hits, 'misses': self.misses, 'evicted': self.evicted}
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+"""
+Minimal Prometheus metrics, rendered in the text exposition format.
+Updating a metric is a dict lookup and an addition, cheap enough to leave on in production.
+"""
+
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from lib import trace
+
+_metrics = []
+_collectors = []
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ''
+    pairs = ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                     for k, v in labels.items())
+    return '{' + pairs + '}'
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self._values = {}   # sorted label items -> value
+        _metrics.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        for key, value in self._values.items():
+            lines.append(f'{self.name}{_format_labels(dict(key))} {value}')
+        return lines
+
+
+class Histogram:
+    default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+    def __init__(self, name: str, documentation: str, buckets: tuple = default_buckets):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self._values = {}   # sorted label items -> [bucket counts..., sum, count]
+        _metrics.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        values = self._values.get(key)
+        if values is None:
+            values = self._values[key] = [0] * (len(self.buckets) + 2)
+        index = bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            values[index] += 1
+        values[-2] += value
+        values[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for key, values in self._values.items():
+            labels = dict(key)
+            cumulative = 0
+            for bucket, count in zip(self.buckets, values):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_format_labels(labels | {"le": bucket})} {cumulative}')
+            lines.append(f'{self.name}_bucket{_format_labels(labels | {"le": "+Inf"})} {values[-1]}')
+            lines.append(f'{self.name}_sum{_format_labels(labels)} {values[-2]}')
+            lines.append(f'{self.name}_count{_format_labels(labels)} {values[-1]}')
+        return lines
+
+
+def register_stats(name: str, func, **labels):
+    """
+    Export the numeric values of a stats() function as gauges, they are read when metrics are rendered
+    :param name: prefix of the gauges, e.g. 'tweet_cache' gives twigram_tweet_cache_hits
+    :param func: function() -> dict, or list of dicts which have a 'name' key
+    :param labels: constant labels of the gauges
+    :return:
+    """
+    _collectors.append((name, func, labels))
+
+
+def _render_stats() -> list[str]:
+    lines = []
+    for name, func, labels in _collectors:
+        try:
+            stats = func()
+        except Exception:
+            continue
+        if isinstance(stats, dict):
+            stats = [stats]
+        for item in stats:
+            item_labels = labels | ({'name': item['name']} if 'name' in item else {})
+            for key, value in item.items():
+                if isinstance(value, (bool, int, float)):
+                    lines.append(f'twigram_{name}_{key}{_format_labels(item_labels)} {float(value)}')
+    return lines
+
+
+def render() -> str:
+    lines = []
+    for metric in _metrics:
+        lines += metric.render()
+    lines += _render_stats()
+    return '\n'.join(lines) + '\n'
+
+
+stage_seconds = Histogram('twigram_stage_seconds', 'Latency of pipeline stages')
+downloaded_bytes = Counter('twigram_downloaded_bytes_total', 'Bytes of media downloaded')
+uploaded_bytes = Counter('twigram_uploaded_bytes_total', 'Bytes of media uploaded to Telegram')
+scraper_errors = Counter('twigram_scraper_errors_total', 'Tweet fetch errors by kind')
+scraper_retries = Counter('twigram_scraper_retries_total', 'Tweet fetch retries')
+url_media = Counter('twigram_url_media_total', 'Tweets whose media were sent by url, by result')
+
+
+@contextmanager
+def stage(name: str, **attrs):
+    """
+    Time a pipeline stage, it's also a span of the current trace
+        with metrics.stage('get_tweet', tweet_id=tweet_id):
+            ...
+    :param name:
+    :param attrs: attributes of the span, they are not labels of the metric
+    """
+    with trace.span(name, **attrs) as span, stage_seconds.time(stage=name):
+        yield span
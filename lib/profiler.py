@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+from lib.logger import logger
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler of all threads of the process, a background thread samples their stacks
+    with sys._current_frames() every interval seconds. Nothing is instrumented, so the overhead is
+    only the sampling thread, and it's off unless a profile is running.
+    The result is in the collapsed stack format of flamegraph.pl and speedscope, one stack per line:
+        thread;file:function;file:function count
+    Coroutines show up in the stack of the event loop thread while they are running,
+    time waiting for I/O shows up as the selector of the loop.
+    """
+
+    max_depth = 64
+
+    def __init__(self):
+        self._lock = asyncio.Lock()
+
+    async def profile(self, seconds: float, interval: float = 0.005) -> str:
+        """
+        Sample all threads for seconds, one profile runs at a time
+        :param seconds:
+        :param interval: seconds between samples
+        :return: collapsed stacks, the most frequent first
+        :raise RuntimeError: another profile is running
+        """
+        if self._lock.locked():
+            raise RuntimeError('A profile is already running')
+
+        async with self._lock:
+            stacks = Counter()
+            stop = threading.Event()
+            thread = threading.Thread(target=self._sample, args=(stacks, stop, interval),
+                                      name='twigram-profiler', daemon=True)
+            logger.info(f'Profiling for {seconds} seconds, every {interval * 1000:.1f} ms')
+            thread.start()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                stop.set()
+                await asyncio.get_running_loop().run_in_executor(None, thread.join)
+
+        return ''.join(f'{stack} {count}\n' for stack, count in stacks.most_common())
+
+    def _sample(self, stacks: Counter, stop: threading.Event, interval: float):
+        me = threading.get_ident()
+        names = {}
+        while not stop.is_set():
+            start = time.perf_counter()
+            if len(names) != threading.active_count():
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stacks[self._collapse(names.get(ident, str(ident)), frame)] += 1
+            stop.wait(max(interval - (time.perf_counter() - start), 0))
+
+    def _collapse(self, thread_name: str, frame) -> str:
+        frames = []
+        while frame is not None and len(frames) < self.max_depth:
+            code = frame.f_code
+            frames.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+            frame = frame.f_back
+        frames.append(thread_name)
+        return ';'.join(reversed(frames))
+
+
+profiler = SamplingProfiler()
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+
+
+class SingleFlight:
+    """
+    Share one in-flight call per key among concurrent callers.
+    Every acquire() must be paired with a release(), the result stays shared while any caller holds it,
+    so a caller arriving after the call finished but before the others are done gets the same result.
+    """
+
+    def __init__(self):
+        self._calls = {}    # key -> [task, reference count]
+        self.calls = 0      # number of real calls
+        self.shared = 0     # number of callers served by another caller's call
+
+    def __contains__(self, key):
+        return key in self._calls
+
+    async def acquire(self, key, func, *args):
+        """
+        Call func(*args), or wait for the in-flight call with the same key
+        :param key:
+        :param func: async function
+        :param args:
+        :return: result of func
+        """
+        entry = self._calls.get(key)
+        if entry is None:
+            entry = self._calls[key] = [asyncio.ensure_future(func(*args)), 0]
+            entry[0].add_done_callback(self._retrieve_exception)
+            self.calls += 1
+        else:
+            self.shared += 1
+        entry[1] += 1
+
+        try:
+            # shield the shared call, a cancelled caller must not cancel it for the others
+            return await asyncio.shield(entry[0])
+        except BaseException:
+            self.release(key)
+            raise
+
+    def release(self, key):
+        """
+        Release the result of key
+        :param key:
+        :return: the result if this was the last reference and the call succeeded, otherwise None
+        """
+        entry = self._calls.get(key)
+        if entry is None:
+            return None
+
+        entry[1] -= 1
+        if entry[1] > 0:
+            return None
+
+        del self._calls[key]
+        task = entry[0]
+        if not task.done():
+            task.cancel()
+            return None
+        if task.cancelled() or task.exception() is not None:
+            return None
+        return task.result()
+
+    @staticmethod
+    def _retrieve_exception(task: asyncio.Future):
+        # avoid "exception was never retrieved" when every caller is gone
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self) -> dict:
+        return {'in_flight': len(self._calls), 'calls': self.calls, 'shared': self.shared}
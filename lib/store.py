@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from lib.logger import logger
+
+
+class SharedStore:
+    """
+    Key-value store with TTL shared by the worker processes, SQLite in WAL mode.
+    Values are json encoded. Operations are short transactions on a local file, errors are logged and
+    treated as a miss, so a busy store never breaks a request.
+    SQLite calls block for up to the busy timeout, so they run in a thread of the store, never on the event loop:
+    reads are awaited, writes are queued and return at once. The thread runs them in order.
+    """
+
+    purge_interval = 1000   # purge expired entries every N writes
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='twigram-store')
+        self.conn = sqlite3.connect(path, timeout=1, isolation_level=None, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS kv (ns TEXT NOT NULL, key TEXT NOT NULL, value TEXT, '
+                          'expire_at REAL NOT NULL, PRIMARY KEY (ns, key))')
+
+    def _execute(self, sql: str, params: tuple = ()):
+        with self._lock:
+            return self.conn.execute(sql, params).fetchone()
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def get(self, ns: str, key):
+        """
+        :param ns: namespace
+        :param key:
+        :return: value, or None if it's missing or expired
+        """
+        entry = await self.get_with_ttl(ns, key)
+        return entry[0] if entry else None
+
+    async def get_with_ttl(self, ns: str, key) -> tuple | None:
+        """
+        :param ns: namespace
+        :param key:
+        :return: (value, seconds until it expires), or None if it's missing or expired
+        """
+        return await self._run(self._get_with_ttl, ns, key)
+
+    def _get_with_ttl(self, ns: str, key) -> tuple | None:
+        now = time.time()
+        try:
+            row = self._execute('SELECT value, expire_at FROM kv WHERE ns = ? AND key = ? AND expire_at > ?',
+                                (ns, str(key), now))
+        except sqlite3.Error as e:
+            logger.debug(f'Shared store get {ns}/{key} failed: {e}')
+            return None
+        return (json.loads(row[0]), row[1] - now) if row else None
+
+    def set(self, ns: str, key, value, ttl: float):
+        """
+        Queue a write, it doesn't wait for the store
+        """
+        self._executor.submit(self._set, ns, key, json.dumps(value), time.time() + ttl)
+
+    def _set(self, ns: str, key, value: str, expire_at: float):
+        try:
+            self._execute('INSERT OR REPLACE INTO kv (ns, key, value, expire_at) VALUES (?, ?, ?, ?)',
+                          (ns, str(key), value, expire_at))
+        except sqlite3.Error as e:
+            logger.debug(f'Shared store set {ns}/{key} failed: {e}')
+            return
+        self._writes += 1
+        if self._writes % self.purge_interval == 0:
+            self._purge()
+
+    def delete(self, ns: str, key):
+        """
+        Queue a delete, it doesn't wait for the store
+        """
+        self._executor.submit(self._delete, ns, key)
+
+    def _delete(self, ns: str, key):
+        try:
+            self._execute('DELETE FROM kv WHERE ns = ? AND key = ?', (ns, str(key)))
+        except sqlite3.Error as e:
+            logger.debug(f'Shared store delete {ns}/{key} failed: {e}')
+
+    async def claim(self, ns: str, key, owner, ttl: float) -> bool:
+        """
+        Claim key for owner, e.g. a tweet being downloaded by a worker
+        :param ns:
+        :param key:
+        :param owner: json serializable id of the claimer
+        :param ttl: the claim expires after ttl seconds, in case the owner dies
+        :return: True if the key is claimed by owner now, False if another owner holds it
+        """
+        return await self._run(self._claim, ns, key, owner, ttl)
+
+    def _claim(self, ns: str, key, owner, ttl: float) -> bool:
+        now = time.time()
+        try:
+            with self._lock:
+                self.conn.execute('DELETE FROM kv WHERE ns = ? AND key = ? AND expire_at <= ?', (ns, str(key), now))
+                self.conn.execute('INSERT OR IGNORE INTO kv (ns, key, value, expire_at) VALUES (?, ?, ?, ?)',
+                                  (ns, str(key), json.dumps(owner), now + ttl))
+                row = self.conn.execute('SELECT value FROM kv WHERE ns = ? AND key = ?', (ns, str(key))).fetchone()
+        except sqlite3.Error as e:
+            logger.debug(f'Shared store claim {ns}/{key} failed: {e}')
+            return True     # can't coordinate, go on as if there were no other worker
+        return row is None or json.loads(row[0]) == owner
+
+    def purge(self):
+        """
+        Queue removing the expired entries
+        """
+        self._executor.submit(self._purge)
+
+    def _purge(self):
+        try:
+            self._execute('DELETE FROM kv WHERE expire_at <= ?', (time.time(),))
+        except sqlite3.Error as e:
+            logger.debug(f'Shared store purge failed: {e}')
+
+
+_store = None
+
+
+def get_store() -> SharedStore | None:
+    """
+    The shared store of this process, enabled by SHARED_STORE=<path of the SQLite file>
+    :return: SharedStore, or None if it's not enabled
+    """
+    global _store
+    path = os.environ.get('SHARED_STORE')
+    if not path:
+        return None
+    if _store is None:
+        try:
+            _store = SharedStore(path)
+            logger.info(f'Shared store: {path}')
+        except sqlite3.Error as e:
+            logger.error(f'Failed to open shared store {path}: {e}')
+            return None
+    return _store
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+"""
+Lightweight trace spans, one trace id per update.
+The current trace and span are context variables, so they follow the calls and the tasks created by them.
+Each finished span is written as a JSON line to the 'twigram.trace' logger, e.g.
+    {"trace": "3f2a...", "span": "get_tweet", "parent": "update", "start": 1700000000.123, "duration_ms": 812.4}
+"""
+
+import json
+import logging
+import random
+import sys
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from lib.utils import env_bool, env_float
+
+enabled = env_bool('TRACE', True)
+sample_rate = env_float('TRACE_SAMPLE_RATE', 1.0)
+
+_trace_id = ContextVar('trace_id', default=None)
+_span = ContextVar('span', default=None)
+
+
+def _get_logger() -> logging.Logger:
+    # JSON lines only, without the prefix of the root logger
+    _logger = logging.getLogger('twigram.trace')
+    if not _logger.handlers:
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        _logger.addHandler(handler)
+        _logger.setLevel(logging.INFO)
+        _logger.propagate = False
+    return _logger
+
+
+logger = _get_logger()
+
+
+class Span:
+    def __init__(self, name: str, parent, attrs: dict):
+        self.name = name
+        self.parent = parent
+        self.attrs = attrs
+        self.counters = {}  # e.g. bytes, added by add()
+        self.start = time.time()
+
+    def add(self, key: str, amount: int = 1):
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+
+def current_trace_id() -> str | None:
+    return _trace_id.get()
+
+
+@contextmanager
+def start_trace():
+    """
+    Start a trace with a new id, spans in the context belong to it
+        with trace.start_trace(), trace.span('update', update_id=123):
+            ...
+    Traces are sampled by TRACE_SAMPLE_RATE, spans of an unsampled trace are not recorded.
+    :return: trace id, or None if it's not sampled
+    """
+    if not enabled or random.random() >= sample_rate:
+        yield None
+        return
+
+    trace_id = uuid.uuid4().hex[:16]
+    token = _trace_id.set(trace_id)
+    try:
+        yield trace_id
+    finally:
+        _trace_id.reset(token)
+
+
+@contextmanager
+def span(name: str, **attrs):
+    """
+    Record a span in the current trace, nothing is recorded outside of a trace
+        with trace.span('get_tweet', tweet_id=tweet_id):
+            ...
+    """
+    trace_id = _trace_id.get()
+    if trace_id is None:
+        yield None
+        return
+
+    parent = _span.get()
+    current = Span(name, parent, attrs)
+    token = _span.set(current)
+    error = None
+    try:
+        yield current
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        _span.reset(token)
+        _emit(trace_id, current, time.time() - current.start, error)
+
+
+def add(key: str, amount: int = 1):
+    """
+    Add to a counter of the current span, e.g. trace.add('bytes', len(chunk))
+    """
+    current = _span.get()
+    if current is not None:
+        current.add(key, amount)
+
+
+def _emit(trace_id: str, current: Span, duration: float, error: str | None):
+    record = {'trace': trace_id, 'span': current.name, 'parent': current.parent.name if current.parent else None,
+              'start': round(current.start, 3), 'duration_ms': round(duration * 1000, 1)}
+    record.update(current.counters)
+    record.update(current.attrs)
+    if error:
+        record['error'] = error
+    logger.info(json.dumps(record, default=str))
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+from collections import Counter
+
+import httpx
+
+
+class _ReleasingStream(httpx.AsyncByteStream):
+    """
+    Response body which calls release() once, when it's closed
+    """
+
+    def __init__(self, stream: httpx.AsyncByteStream, release):
+        self._stream = stream
+        self._release = release
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self._stream.aclose()
+        finally:
+            if self._release is not None:
+                self._release()
+                self._release = None
+
+
+class PoolTransport(httpx.AsyncBaseTransport):
+    """
+    Transport of the shared Session: limits concurrent requests per host, and reports pool utilization.
+    A request holds its host slot until its response is closed, so a streamed download counts until it's done.
+    With HTTP/2, requests to a host are streams multiplexed on its connections, new TCP connections are
+    counted with the httpcore trace extension, so reuse_ratio is the share of requests on an existing connection.
+    """
+
+    def __init__(self, transport: httpx.AsyncHTTPTransport, per_host: int = 0):
+        """
+        :param transport:
+        :param per_host: max concurrent requests to one host, 0 for no limit
+        """
+        self.transport = transport
+        self.per_host = per_host
+        self._hosts = {}    # host -> [semaphore, number of requests holding or waiting for it]
+        self.requests = 0
+        self.in_flight = 0
+        self.host_waits = 0
+        self.connections_opened = 0
+        self.http_versions = Counter()
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        host = request.url.host
+        if self.per_host > 0:
+            entry = self._hosts.get(host)
+            if entry is None:
+                entry = self._hosts[host] = [asyncio.Semaphore(self.per_host), 0]
+            entry[1] += 1
+            if entry[0].locked():
+                self.host_waits += 1
+            try:
+                await entry[0].acquire()
+            except BaseException:
+                self._leave(host)
+                raise
+
+        released = False
+
+        def release():
+            nonlocal released
+            if not released:
+                released = True
+                self.in_flight -= 1
+                if self.per_host > 0:
+                    self._hosts[host][0].release()
+                    self._leave(host)
+
+        self.requests += 1
+        self.in_flight += 1
+        request.extensions.setdefault('trace', self._trace)
+        try:
+            response = await self.transport.handle_async_request(request)
+        except BaseException:
+            release()
+            raise
+
+        self.http_versions[response.extensions.get('http_version', b'').decode(errors='replace')] += 1
+        return httpx.Response(status_code=response.status_code, headers=response.headers,
+                              stream=_ReleasingStream(response.stream, release), extensions=response.extensions)
+
+    def _leave(self, host: str):
+        entry = self._hosts[host]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self._hosts[host]   # redirects go to arbitrary hosts, don't keep them
+
+    async def _trace(self, event: str, info: dict):
+        if event == 'connection.connect_tcp.complete':
+            self.connections_opened += 1
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+    def stats(self) -> dict:
+        connections = list(getattr(getattr(self.transport, '_pool', None), 'connections', []))
+        idle = sum(1 for connection in connections if connection.is_idle())
+        http2 = sum(1 for connection in connections if 'HTTP/2' in connection.info())
+        return {'requests': self.requests, 'in_flight': self.in_flight, 'host_waits': self.host_waits,
+                'hosts': len(self._hosts), 'connections': len(connections), 'active': len(connections) - idle,
+                'idle': idle, 'http2_connections': http2, 'connections_opened': self.connections_opened,
+                'http2_requests': self.http_versions.get('HTTP/2', 0),
+                'reuse_ratio': round(1 - self.connections_opened / self.requests, 4) if self.requests else 0.0}
@@ -1,14 +1,29 @@
 # -*- coding: utf-8 -*-
 
+import asyncio
 import httpx
+import os
 import re
+import tempfile
+import threading
+from collections import deque
 from urllib.parse import urlparse
 
+from lib.cache import TTLCache
+from lib.executor import InstrumentedExecutor
 from lib.logger import logger
+from lib.store import get_store
+from lib.transport import PoolTransport
 
 
 class Session(httpx.AsyncClient):
-    def __init__(self, connections=20, retries=5):
+    """
+    HTTP/2 client of the process, shared by TelegramBot and TwitterClient, see get_session()
+    Requests use the timeout profile of their kind: redirect_timeout, media_timeout or probe_timeout,
+    other requests (e.g. GraphQL) use the default timeout.
+    """
+
+    def __init__(self, connections=20, retries=5, per_host=0):
         self.default_header = {'User-Agent': 'Mozilla/5.0 (Macintosh; Mac OS X 10_15_7) '
                                              'AppleWebKit/537.36 (KHTML, like Gecko) Chrome/116.0.0.0 Safari/537.36'}
         self.twitter_set = {'twitter.com', 'www.twitter.com', 'mobile.twitter.com', 'x.com', 'www.x.com'}
@@ -20,9 +35,20 @@ class Session(httpx.AsyncClient):
         self.x_set = {'x.com', 'www.x.com'}
         limits = httpx.Limits(max_connections=connections * 2, max_keepalive_connections=connections)
         http_transport = httpx.AsyncHTTPTransport(http2=True, retries=retries, verify=False, limits=limits)
+        self.pool = PoolTransport(http_transport, per_host=per_host)
 
-        super().__init__(headers=self.default_header, transport=http_transport)
+        super().__init__(headers=self.default_header, transport=self.pool, timeout=env_float('HTTP_TIMEOUT', 5))
         self.session = self
+        self.redirect_timeout = httpx.Timeout(env_float('REDIRECT_TIMEOUT', 5))
+        self.media_timeout = httpx.Timeout(env_float('MEDIA_TIMEOUT', 30), connect=10)
+        self.probe_timeout = httpx.Timeout(env_float('PROBE_TIMEOUT', 5))
+        # resolved final urls, keyed by the tracker-stripped input url
+        self.redirect_cache = TTLCache(maxsize=env_int('REDIRECT_CACHE_SIZE', 4096),
+                                       ttl=env_float('REDIRECT_CACHE_TTL', 3600),
+                                       store=get_store(), namespace='redirect')
+        # hosts which timed out recently, urls of these hosts are not followed
+        self.timeout_hosts = TTLCache(maxsize=1024, ttl=env_float('REDIRECT_NEGATIVE_TTL', 60),
+                                      store=get_store(), namespace='timeout_host')
 
     async def url_strict(self, url: str) -> str:
         """
@@ -32,10 +58,18 @@ class Session(httpx.AsyncClient):
         :return:
         """
         url = self.remove_tracker_from_url(url)  # remove tracking parameters
-        url = await self.url_get_redirect(url, 0)  # follow redirects
-        url = self.remove_tracker_from_url(url)  # remove tracking parameters again
+        cached = await self.redirect_cache.fetch(url)
+        if cached is not None:
+            logger.debug(f'Redirect cache hit: {url} -> {cached}, {self.redirect_cache.stats()}')
+            return cached
 
-        return url
+        final_url, resolved = await self._follow_redirect(url, 0)  # follow redirects
+        final_url = self.remove_tracker_from_url(final_url)  # remove tracking parameters again
+
+        if resolved:
+            # failures are not cached, the url is followed again next time
+            self.redirect_cache.set(url, final_url)
+        return final_url
 
     def remove_tracker_from_url(self, url: str) -> str:
         """
@@ -57,35 +91,255 @@ class Session(httpx.AsyncClient):
         return url_result
 
     async def url_get_redirect(self, url: str, max_times: int) -> str:
+        url, _ = await self._follow_redirect(url, max_times)
+        return url
+
+    async def _follow_redirect(self, url: str, max_times: int) -> tuple[str, bool]:
+        """
+        :param url:
+        :param max_times: redirects followed so far
+        :return: (final url, True if it's resolved: a 200 response or an x.com url),
+                 the last url reached and False if it failed
+        """
         try:
             x = max_times or 0
             x += 1
             if x > 5:
-                return url
+                return url, False
 
             url_parse = urlparse(url)
             if url_parse.hostname in self.x_set:
-                return url
+                return url, True
+            if await self.timeout_hosts.fetch(url_parse.hostname, count=False):
+                logger.info(f'Host {url_parse.hostname} timed out recently, skip following {url}')
+                return url, False
 
-            response = await self.session.get(url, follow_redirects=False)
+            response = await self.session.get(url, follow_redirects=False, timeout=self.redirect_timeout)
             if response.status_code in (301, 302, 303, 307, 308):
                 if response.headers.get('Location') and not response.headers.get('Location').startswith('http'):
                     url_parse = urlparse(url)
                     url = '{}://{}{}'.format(url_parse.scheme, url_parse.hostname, response.headers.get('Location'))
                     url = self.remove_tracker_from_url(url)
-                    return await self.url_get_redirect(url, x)
+                    return await self._follow_redirect(url, x)
                 elif response.headers.get('Location'):
                     url = self.remove_tracker_from_url(response.headers.get('Location'))
-                    return await self.url_get_redirect(url, x)
+                    return await self._follow_redirect(url, x)
                 else:
-                    return url
+                    return url, False
             elif response.status_code == 200:
-                return url
+                return url, True
             else:
-                return url
+                return url, False
+        except httpx.TimeoutException as e:
+            logger.error(f'Timeout following {url}: {e}')
+            self.timeout_hosts.set(urlparse(url).hostname, True)
+            return url, False
         except Exception as e:
             logger.error(e)
-            return url
+            return url, False
+
+
+_session = None
+
+
+def get_session() -> Session:
+    """
+    The shared Session of this process, one connection pool for redirects, tweets and media
+    :return:
+    """
+    global _session
+    if _session is None:
+        _session = Session(connections=env_int('HTTP_CONNECTIONS', 32), per_host=env_int('HTTP_PER_HOST', 64))
+    return _session
+
+
+def env_bool(name: str, default: bool = False) -> bool:
+    value = os.environ.get(name)
+    if value is None or value == '':
+        return default
+    return value in {'True', 'true', 'TRUE', '1'}
+
+
+def env_int(name: str, default: int) -> int:
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        logger.warning('%s is not an integer, use default value %s', name, default)
+        return default
+
+
+def env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        logger.warning('%s is not a number, use default value %s', name, default)
+        return default
+
+
+# dedicated thread pool for media file I/O, keep slow disks from blocking the event loop
+io_executor = InstrumentedExecutor(max_workers=env_int('IO_WORKERS', 4), thread_name_prefix='twigram-io')
+
+
+async def run_io(func, *args):
+    """
+    Run a blocking file I/O function in io_executor
+    :param func:
+    :param args:
+    :return: result of func
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(io_executor, func, *args)
+
+
+class MemoryBudget:
+    """
+    Limit the bytes of media buffered in memory by all downloads of the process
+    It belongs to the event loop, release() may be called from other threads, e.g. by MediaBuffer in io_executor.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self._waiters = deque()
+        self._loop = None
+
+    def try_acquire(self, size: int) -> bool:
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+        if self.used + size > self.limit:
+            return False
+        self.used += size
+        return True
+
+    async def acquire(self, size: int) -> int:
+        """
+        Wait until size bytes are available
+        :param size:
+        :return: bytes acquired, pass it to release()
+        """
+        size = min(size, self.limit)
+        while not self.try_acquire(size):
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+        return size
+
+    def release(self, size: int):
+        """
+        Release bytes acquired before, from any thread
+        """
+        loop = self._loop
+        if loop is not None and not loop.is_closed() and not self._in_loop(loop):
+            loop.call_soon_threadsafe(self._release, size)
+        else:
+            self._release(size)
+
+    @staticmethod
+    def _in_loop(loop) -> bool:
+        try:
+            return asyncio.get_running_loop() is loop
+        except RuntimeError:
+            return False
+
+    def _release(self, size: int):
+        self.used = max(self.used - size, 0)
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def stats(self) -> dict:
+        return {'limit': self.limit, 'used': self.used, 'waiting': len(self._waiters)}
+
+
+class MediaBuffer(tempfile.SpooledTemporaryFile):
+    """
+    Downloaded media kept in memory, rolled over to an anonymous temp file when larger than max_size,
+    or when the memory budget is used up.
+    The size comes from Content-Length of the response, instead of the filesystem.
+    """
+
+    def __init__(self, filename: str, size: int = 0, max_size: int = 8 * 1024**2, temp_dir: str = None,
+                 budget: MemoryBudget = None):
+        self.filename = filename
+        self.size = size
+        self._budget = budget
+        self._reserved = 0
+        self._lock = threading.Lock()
+        super().__init__(max_size=max_size, dir=temp_dir)
+        if size > max_size or (budget and not budget.try_acquire(size)):
+            self.rollover()     # don't buffer it in memory at all
+        else:
+            self._reserved = size if budget else 0
+
+    def read_all(self) -> bytes:
+        """
+        Read the whole content from the beginning, safe to call from several threads
+        :return:
+        """
+        with self._lock:
+            self.seek(0)
+            return self.read()
+
+    def rollover(self):
+        super().rollover()
+        self._release()
+
+    def close(self):
+        super().close()
+        self._release()
+
+    def _release(self):
+        if self._reserved:
+            self._budget.release(self._reserved)
+            self._reserved = 0
+
+
+def media_size(media) -> int:
+    """
+    :param media: file path or MediaBuffer
+    :return: size in bytes
+    """
+    if isinstance(media, MediaBuffer):
+        return media.size
+    return os.path.getsize(media)
+
+
+def read_media(media) -> bytes:
+    """
+    :param media: file path or MediaBuffer
+    :return: content of the media
+    """
+    if isinstance(media, MediaBuffer):
+        return media.read_all()
+    with open(media, 'rb') as f:
+        return f.read()
+
+
+def parse_content_range(value: str) -> tuple[int, int, int] | None:
+    """
+    :param value: Content-Range header, e.g. 'bytes 0-1023/4096'
+    :return: (first byte, last byte, total size), or None if it's missing or the total is unknown
+    """
+    match = re.match(r'^bytes (\d+)-(\d+)/(\d+)$', (value or '').strip())
+    if not match:
+        return None
+    return int(match.group(1)), int(match.group(2)), int(match.group(3))
+
+
+def preallocate(path: str, size: int):
+    """
+    Create a file of size bytes to be filled at any offset
+    """
+    with open(path, 'wb') as f:
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+        except (AttributeError, OSError):
+            f.truncate(size)    # not supported by the platform or the filesystem, sparse file
 
 
 def split_long_string(input_string: str, max_length: int = 4096) -> list:
@@ -1,17 +1,29 @@
 # -*- coding: utf-8 -*-
 
+import asyncio
+import hmac
+import json
 import os
+import random
 import re
 import sys
 import validators
+from collections import deque
 
-from telegram import Update, Message, InputMediaVideo, InputMediaDocument
+from telegram import Update, Message, InputMediaPhoto, InputMediaVideo, InputMediaDocument
+from telegram.error import BadRequest
 from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, filters
 
+from lib import metrics, trace
+from lib.cache import TTLCache
 from lib.lock import FileLock
+from lib.store import get_store
 from lib.logger import logger
-from lib.utils import Session, split_long_string
+from lib.mediastore import original_name
+from lib.utils import get_session, MediaBuffer, media_size, read_media, run_io, split_long_string, env_bool, env_int, \
+    env_float
 from lib import version
+from telebot.processor import ChatUpdateProcessor
 from twitterclient.twitterclient import TwitterClient
 
 _url_prefixes = (r'https://(?:www\.|mobile\.|m\.)?twitter\.com/', r'https://x\.com/')
@@ -21,12 +33,36 @@ class TelegramBot(object):
     def __init__(self, ):
         self.webhook_lock = FileLock('/tmp/twigram.lock')
         self.logger = logger
-        self.application = Application.builder().token(self.get_token()).build()
+        # updates of different chats are processed concurrently, updates of one chat in order
+        self.update_processor = ChatUpdateProcessor(max_concurrent_updates=env_int('UPDATE_CONCURRENCY', 16),
+                                                    max_queue=env_int('UPDATE_QUEUE_SIZE', 256))
+        self.application = Application.builder().token(self.get_token()) \
+            .base_url(os.environ.get('TELEGRAM_API_URL') or 'https://api.telegram.org/bot') \
+            .concurrent_updates(self.update_processor).build()
         self.debug = os.environ.get('DEBUG', False) in {'True', 'true', 'TRUE', '1'}
         self.quote = os.environ.get('QUOTE', False) in {'True', 'true', 'TRUE', '1'}
         self.client = TwitterClient(debug=self.debug)
         self.url_pattern = re.compile('|'.join(_url_prefixes))
-        self.session = Session()
+        self.session = get_session()
+        # Telegram file_id of sent media and their caption, keyed by tweet id:
+        # {'media': [(media type, file_id), ...], 'text': text}, list index is the media index
+        self.store = get_store()
+        self.file_ids = TTLCache(maxsize=env_int('FILE_ID_CACHE_SIZE', 4096),
+                                 ttl=env_float('FILE_ID_CACHE_TTL', 86400),
+                                 store=self.store, namespace='file_ids')
+        self.claim_ttl = env_float('CLAIM_TTL', 120)     # max seconds to wait for a tweet claimed by another worker
+        # let Telegram fetch media under its url limits itself, instead of downloading and uploading them
+        self.send_by_url = env_bool('SEND_BY_URL')
+        # webhook ingestion: raw updates are acked at once and deserialized by the ingest worker
+        self.webhook_secret = os.environ.get('WEBHOOK_SECRET', '')
+        self.ingest_queue = asyncio.Queue(maxsize=env_int('UPDATE_QUEUE_SIZE', 256))
+        self.recent_update_ids = deque(maxlen=env_int('RECENT_UPDATE_IDS', 1024))
+        self._recent_update_id_set = set()
+        self.log_max_length = env_int('LOG_MAX_LENGTH', 512)
+        self.log_sample_rate = env_float('LOG_SAMPLE_RATE', 1.0)
+        self._ingest_task = None
+        self._start_task = None
+        self.url_concurrency = env_int('URL_CONCURRENCY', 4)   # urls of one message processed concurrently
         self.set_bot_handler()
 
     def poll(self):
@@ -45,23 +81,26 @@ class TelegramBot(object):
 
         # Check if webhook is already configured, avoid API response 429 Too Many Requests
         # See https://core.telegram.org/bots/api#setwebhook
+        # The secret token is not returned by getWebhookInfo, so set it again if there is one
         webhook_info = await self.application.bot.get_webhook_info()
-        if webhook_info:
+        if webhook_info and not self.webhook_secret:
             if webhook_info.url == url:
                 self.logger.info('Webhook already configured.')
                 return
 
         lock_acquired = self.webhook_lock.acquire()
         if lock_acquired:
-            result = await self.application.bot.set_webhook(url=url, allowed_updates=Update.MESSAGE)
+            try:
+                result = await self.application.bot.set_webhook(url=url, allowed_updates=Update.MESSAGE,
+                                                                secret_token=self.webhook_secret or None)
+            finally:
+                self.webhook_lock.release()     # start() retries on failure
 
             if result:
                 self.logger.info('Webhook setup OK, URL: %s', url)
             else:
                 self.logger.info('Webhook setup FAILED, URL: %s', url)
                 raise Exception('Webhook setup failed.')
-
-            self.webhook_lock.release()
         else:
             self.logger.info('Acquire lock failed, other process is setting webhook.')
             return
@@ -77,12 +116,115 @@ class TelegramBot(object):
             self.logger.info('Starting bot in polling mode')
             self.poll()
 
-    async def task(self, request):
-        msg = await request.get_json()
-        self.logger.info('Message received: %s', msg)
+    def start(self):
+        """
+        Start the bot in the background, so the server accepts connections at once:
+        Telegram setup is retried until it succeeds, Twitter scrapers are created concurrently.
+        Webhook updates received meanwhile wait in the ingest queue.
+        """
+        self.client.start()
+        self.start_ingest()
+        if self._start_task is None:
+            self._start_task = asyncio.get_running_loop().create_task(self._start())
+
+    async def _start(self):
+        attempt = 0
+        while True:
+            try:
+                await self.run()
+                if not self.application.running:
+                    self.logger.info('Initializing bot')
+                    await self.application.initialize()
+                    await self.application.start()
+                return
+            except Exception as e:
+                attempt += 1
+                delay = min(2 ** attempt, 60)
+                self.logger.error('Failed to start bot, retrying in %s seconds: %s', delay, e)
+                await asyncio.sleep(delay)
+
+    async def stop(self):
+        if self._start_task is not None:
+            self._start_task.cancel()
+            self._start_task = None
+        await self.stop_ingest()
+        await self.client.stop()
+        if self.application.running:
+            await self.application.stop()
+
+    @property
+    def ready(self) -> bool:
+        """
+        Ready to handle updates, Telegram is set up and Twitter scrapers are created
+        """
+        return self.application.running and self.client.ready
+
+    def check_secret(self, secret_token: str | None) -> bool:
+        """
+        Check X-Telegram-Bot-Api-Secret-Token header of a webhook request
+        :param secret_token:
+        :return:
+        """
+        if not self.webhook_secret:
+            return True
+        return hmac.compare_digest((secret_token or '').encode(), self.webhook_secret.encode())
 
-        await self.application.update_queue.put(Update.de_json(msg, self.application.bot))
-        self.logger.info('Queue added.')
+    def ingest(self, body: bytes) -> int:
+        """
+        Enqueue a raw webhook update, duplicate update_ids (redeliveries) are dropped
+        :param body: request body
+        :return: HTTP status code of the webhook response
+        """
+        match = re.match(rb'\s*\{\s*"update_id"\s*:\s*(\d+)', body)    # Telegram sends update_id first
+        if match:
+            update_id = int(match.group(1))
+        else:
+            try:
+                update_id = int(json.loads(body)['update_id'])
+            except (ValueError, KeyError, TypeError):
+                self.logger.warning('Update without update_id dropped')
+                return 400
+
+        if update_id in self._recent_update_id_set:
+            self.logger.info('Duplicate update %s dropped', update_id)
+            return 200
+
+        try:
+            self.ingest_queue.put_nowait(body)
+        except asyncio.QueueFull:
+            self.logger.warning('Ingest queue is full, update %s rejected', update_id)
+            return 429      # Telegram delivers it again later
+
+        if len(self.recent_update_ids) == self.recent_update_ids.maxlen:
+            self._recent_update_id_set.discard(self.recent_update_ids[0])
+        self.recent_update_ids.append(update_id)
+        self._recent_update_id_set.add(update_id)
+        return 200
+
+    def start_ingest(self):
+        if self._ingest_task is None:
+            self._ingest_task = asyncio.get_running_loop().create_task(self.ingest_worker())
+
+    async def stop_ingest(self):
+        if self._ingest_task is not None:
+            self._ingest_task.cancel()
+            self._ingest_task = None
+
+    async def ingest_worker(self):
+        """
+        Deserialize raw updates from the ingest queue and hand them over to the application
+        """
+        while True:
+            body = await self.ingest_queue.get()
+            try:
+                msg = json.loads(body)
+                if random.random() < self.log_sample_rate:
+                    self.logger.info('Message received: %s', body[:self.log_max_length].decode(errors='replace'))
+
+                await self.update_processor.wait_for_capacity()    # backpressure, the ingest queue fills up
+                await self.application.update_queue.put(Update.de_json(msg, self.application.bot))
+            except Exception as e:
+                self.logger.error('Failed to process update: %s', e)
 
     def get_token(self) -> str:
         token = os.environ.get('TOKEN', None)
@@ -111,20 +253,158 @@ class TelegramBot(object):
         await update.message.reply_markdown(escaped_text, do_quote=self.quote)
 
     async def download(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        urls = await self.get_urls(update.message)
-        if not urls:
-            await self.reply_text(update, "Can't find any Twitter url in your message.")
-        for url in urls[:10]:   # limit to 10 urls
-            await self.download_twitter(update, url)
+        with trace.start_trace(), metrics.stage('update', update_id=update.update_id,
+                                                chat_id=update.effective_chat.id if update.effective_chat else None):
+            with metrics.stage('extract_url'):
+                urls = await self.get_urls(update.message)
+            if not urls:
+                await self.reply_text(update, "Can't find any Twitter url in your message.")
+            urls = urls[:10]    # limit to 10 urls
+            if self.url_concurrency > 1 and len(urls) > 1:
+                await self.download_concurrently(update, urls)
+            else:
+                for url in urls:
+                    await self.download_twitter(update, url)
+
+    async def download_concurrently(self, update: Update, urls: list[str]):
+        """
+        Fetch tweets and download media of all urls concurrently, limited by self.url_concurrency.
+        Replies are sent in the original url order, each one as soon as it and all earlier ones are ready.
+        :param update:
+        :param urls:
+        :return:
+        """
+        semaphore = asyncio.Semaphore(self.url_concurrency)
+
+        async def fetch(url: str) -> tuple:
+            async with semaphore:
+                return await self.fetch_twitter(url)
+
+        tasks = [asyncio.create_task(fetch(url)) for url in urls]
+        replied = 0
+        try:
+            for url, task in zip(urls, tasks):
+                replied += 1
+                try:
+                    fetched = await task
+                except Exception as e:
+                    self.logger.error('Failed to download %s: %s', url, e)
+                    await self.reply_text(update, 'Download failed.')
+                    continue
+                await self.reply_twitter(update, fetched)
+        finally:
+            for task in tasks[replied:]:
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled() and task.exception() is None:
+                    await self.delete_files(task.result())
 
     async def download_twitter(self, update: Update, url: str):
-        images_path, videos_path, text = await self.client.download(url)
-        if len(images_path) + len(videos_path) > 0:
-            await self.send_media(update=update, images_path=images_path, videos_path=videos_path, text=text)
-        elif text:
-            await self.reply_text(update, text)
-        else:
+        try:
+            fetched = await self.fetch_twitter(url)
+        except Exception as e:
+            self.logger.error('Failed to download %s: %s', url, e)
             await self.reply_text(update, 'Download failed.')
+            return
+        await self.reply_twitter(update, fetched)
+
+    async def fetch_twitter(self, url: str) -> tuple:
+        """
+        Fetch tweet and download its media, media already sent to Telegram is not downloaded again
+        With self.send_by_url, media under the url limits of Telegram are not downloaded either,
+        file_ids are their urls then.
+        :param url:
+        :return: tweet_id, file_ids, images_path, videos_path, text, number of media of the tweet
+        """
+        tweet_id = self.client.get_tweet_id(url)
+        sent = await self.file_ids.fetch(tweet_id)
+        claimed = False
+        if not sent and self.store is not None:
+            claimed = await self.store.claim('inflight', tweet_id, os.getpid(), self.claim_ttl)
+            if not claimed:
+                # another worker is sending this tweet, wait for its file_id instead of downloading it again
+                sent = await self.wait_for_file_ids(tweet_id)
+        try:
+            if sent:
+                # media of this tweet is already on Telegram server, skip fetching, download and upload
+                self.logger.info('Tweet %s media found in file_id cache', tweet_id)
+                return tweet_id, sent['media'], [], [], sent['text'], len(sent['media'])
+            if self.send_by_url:
+                url_media = await self.client.get_url_media(url)
+                if url_media:
+                    media, text = url_media
+                    return tweet_id, media, [], [], text, len(media)
+
+            images_path, videos_path, text, media_count = await self.client.download(url)
+            return tweet_id, None, images_path, videos_path, text, media_count
+        except BaseException:
+            # nothing will be sent, let other workers go on
+            if claimed:
+                self.store.delete('inflight', tweet_id)
+            raise
+
+    async def wait_for_file_ids(self, tweet_id: int) -> dict | None:
+        """
+        Wait until the worker which claimed the tweet has sent it, or gave up
+        :param tweet_id:
+        :return: file_ids and text of the tweet, see self.file_ids, or None if there are none
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.claim_ttl
+        while loop.time() < deadline:
+            await asyncio.sleep(0.5)
+            sent = await self.file_ids.fetch(tweet_id, count=False)
+            if sent or await self.store.get('inflight', tweet_id) is None:
+                return sent
+        return None
+
+    async def reply_twitter(self, update: Update, fetched: tuple):
+        tweet_id, file_ids, images_path, videos_path, text, media_count = fetched
+        try:
+            if file_ids:
+                by_url = file_ids[0][1].startswith(('https://', 'http://'))
+                try:
+                    await self.send_cached_media(update=update, file_ids=file_ids, text=text,
+                                                 tweet_id=tweet_id if by_url else 0)
+                    if by_url:
+                        metrics.url_media.inc(result='ok')
+                except BadRequest as e:
+                    if by_url:
+                        # Telegram failed to fetch the urls, upload the media instead
+                        self.logger.warning('Failed to send tweet %s media by url: %s', tweet_id, e)
+                        metrics.url_media.inc(result='fallback')
+                    else:
+                        # the file_id is no longer valid, forget it and upload the media again
+                        self.logger.warning('Failed to send tweet %s media by cached file_id: %s', tweet_id, e)
+                        self.file_ids.pop(tweet_id)
+                    await self.upload_twitter(update, tweet_id, text)
+            elif len(images_path) + len(videos_path) > 0:
+                await self.send_media(update=update, images_path=images_path, videos_path=videos_path, text=text,
+                                      tweet_id=tweet_id, media_count=media_count)
+            elif text:
+                await self.reply_text(update, text)
+            else:
+                await self.reply_text(update, 'Download failed.')
+        finally:
+            await self.delete_files(fetched)
+
+    async def upload_twitter(self, update: Update, tweet_id: int, text: str):
+        """
+        Download media of a tweet and upload them
+        :param update:
+        :param tweet_id:
+        :param text: text of the tweet with its url
+        :return:
+        """
+        try:
+            images_path, videos_path, _, media_count = await self.client.download_by_id(tweet_id)
+            if len(images_path) + len(videos_path) > 0:
+                await self.send_media(update=update, images_path=images_path, videos_path=videos_path, text=text,
+                                      tweet_id=tweet_id, media_count=media_count)
+            else:
+                await self.reply_text(update, 'Download failed.')
+        finally:
+            await self.client.release(tweet_id)
 
     async def reply_text(self, update: Update, text: str):
         quote = self.quote
@@ -136,55 +416,156 @@ class TelegramBot(object):
                 await update.message.reply_text(text_part, do_quote=quote, disable_web_page_preview=True)
                 quote = False
 
-    async def send_media(self, update: Update, images_path: list[str], videos_path: list[str], text: str = ''):
-        async def relpy_media_group(caption: str = ''):
+    async def send_media(self, update: Update, images_path: list[str], videos_path: list[str], text: str = '',
+                         tweet_id: int = 0, media_count: int = 0):
+        """
+        Upload downloaded media
+        :param update:
+        :param images_path:
+        :param videos_path:
+        :param text:
+        :param tweet_id: save file_id of the sent media for this tweet, 0 to skip
+        :param media_count: number of media of the tweet, file_id is saved only if all of them are sent
+        :return:
+        """
+        with metrics.stage('send_media', tweet_id=tweet_id):
+            await self._send_media(update, images_path, videos_path, text, tweet_id, media_count)
+
+    async def _send_media(self, update: Update, images_path: list[str], videos_path: list[str], text: str = '',
+                          tweet_id: int = 0, media_count: int = 0):
+        async def relpy_media_group(caption: str = '') -> list[Message]:
+            with metrics.stage('reply_media_group'):
+                return await _relpy_media_group(caption)
+
+        async def _relpy_media_group(caption: str = '') -> list[Message]:
+            messages = []
             if medias_image or medias_video:
                 if total_size > 50 * 1024**2:
                     self.logger.info('Media group too large, send separately.')
                     if medias_image:
-                        await update.message.reply_media_group(media=medias_image, caption=caption,
-                                                               do_quote=self.quote, write_timeout=600)
+                        messages += await update.message.reply_media_group(media=medias_image, caption=caption,
+                                                                           do_quote=self.quote, write_timeout=600)
                     if medias_video:
                         for i in range(len(medias_video)):
                             caption_temp = caption if i == 0 else ''
-                            await update.message.reply_media_group(media=[medias_video[i]], caption=caption_temp,
-                                                                   do_quote=self.quote, write_timeout=600)
+                            messages += await update.message.reply_media_group(media=[medias_video[i]],
+                                                                               caption=caption_temp,
+                                                                               do_quote=self.quote,
+                                                                               write_timeout=600)
                 else:
                     medias = medias_image + medias_video
-                    await update.message.reply_media_group(media=medias, caption=caption,
-                                                           do_quote=self.quote, write_timeout=600)
+                    messages += await update.message.reply_media_group(media=medias, caption=caption,
+                                                                       do_quote=self.quote, write_timeout=600)
+            return messages
 
         medias_image, medias_video = [], []
         total_size = 0
 
         if images_path:
             for image_path in images_path:
-                total_size += os.path.getsize(image_path)
-                medias_image.append(InputMediaDocument(media=open(image_path, 'rb')))
+                total_size += await run_io(media_size, image_path)
+                medias_image.append(InputMediaDocument(**await self.media_input(image_path)))
 
         for video_path in videos_path:
-            total_size += os.path.getsize(video_path)
+            total_size += await run_io(media_size, video_path)
             if images_path:
-                medias_video.append(InputMediaDocument(media=open(video_path, 'rb')))
+                medias_video.append(InputMediaDocument(**await self.media_input(video_path)))
             else:
-                medias_video.append(InputMediaVideo(media=open(video_path, 'rb'), supports_streaming=True))
+                medias_video.append(InputMediaVideo(**await self.media_input(video_path), supports_streaming=True))
 
         if len(text) > 1024:
-            await relpy_media_group()
+            sent = await relpy_media_group()
             await self.reply_text(update, text)
         else:
-            await relpy_media_group(caption=text)
+            sent = await relpy_media_group(caption=text)
 
-        if not self.debug:
-            await self.delete_files(images_path, videos_path)
+        metrics.uploaded_bytes.inc(total_size)
+        trace.add('bytes', total_size)
+        if tweet_id:
+            self.save_file_ids(tweet_id, sent, len(medias_image) + len(medias_video), media_count, text)
 
     @staticmethod
-    async def delete_files(images_path: list[str], videos_path: list[str]):
-        for image_path in images_path:
-            os.remove(image_path)
+    async def media_input(media) -> dict:
+        """
+        Arguments of InputMedia for a downloaded media, the content is read in the I/O thread pool
+        :param media: file path or MediaBuffer
+        :return:
+        """
+        if isinstance(media, MediaBuffer):
+            filename = media.filename
+        else:
+            filename = original_name(media)
+        return {'media': await run_io(read_media, media), 'filename': filename}
 
-        for video_path in videos_path:
-            os.remove(video_path)
+    async def send_cached_media(self, update: Update, file_ids: list[tuple[str, str]], text: str = '',
+                                tweet_id: int = 0):
+        """
+        Send media which is already on Telegram server by file_id, or which Telegram fetches by url
+        :param update:
+        :param file_ids: [(media type, file_id or url), ...], media type is 'document', 'photo' or 'video'
+        :param text:
+        :param tweet_id: save file_id of the sent media for this tweet, 0 to skip
+        :return:
+        """
+        medias = []
+        for media_type, file_id in file_ids:
+            if media_type == 'video':
+                medias.append(InputMediaVideo(media=file_id, supports_streaming=True))
+            elif media_type == 'photo':
+                medias.append(InputMediaPhoto(media=file_id))
+            else:
+                medias.append(InputMediaDocument(media=file_id))
+
+        if len(text) > 1024:
+            with metrics.stage('reply_media_group_cached'):
+                sent = await update.message.reply_media_group(media=medias, do_quote=self.quote)
+            await self.reply_text(update, text)
+        else:
+            with metrics.stage('reply_media_group_cached'):
+                sent = await update.message.reply_media_group(media=medias, caption=text, do_quote=self.quote)
+
+        if tweet_id:
+            self.save_file_ids(tweet_id, sent, len(medias), len(medias), text)
+
+    def save_file_ids(self, tweet_id: int, messages: list[Message], sent_count: int, media_count: int,
+                      text: str):
+        """
+        Save file_id of sent media, so the same tweet can be sent again without downloading and uploading
+        :param tweet_id:
+        :param messages: messages returned by reply_media_group, in the same order as the media
+        :param sent_count: number of media sent
+        :param media_count: number of media of the tweet, skip saving if some of them failed to download or send
+        :param text: caption of the media, saved with them so the tweet isn't fetched again
+        :return:
+        """
+        file_ids = []
+        for message in messages:
+            if message.video:
+                file_ids.append(('video', message.video.file_id))
+            elif message.photo:
+                file_ids.append(('photo', message.photo[-1].file_id))   # the largest size
+            elif message.document:
+                file_ids.append(('document', message.document.file_id))
+
+        if file_ids and len(file_ids) == sent_count == media_count:
+            self.file_ids.set(tweet_id, {'media': file_ids, 'text': text})
+        else:
+            self.logger.info('Tweet %s has %s media, sent %s, got %s file_id, not cached',
+                             tweet_id, media_count, sent_count, len(file_ids))
+
+    async def delete_files(self, fetched: tuple):
+        """
+        Release downloaded media of a tweet, files stay in the media store of the client to be reused
+        :param fetched: result of fetch_twitter()
+        :return:
+        """
+        tweet_id, file_ids, _, _, _, _ = fetched
+        if self.store is not None and await self.store.get('inflight', tweet_id) == os.getpid():
+            self.store.delete('inflight', tweet_id)     # let other workers go on
+        if file_ids:
+            return  # nothing downloaded
+
+        await self.client.release(tweet_id)
 
     async def get_urls(self, message: Message) -> list:
         urls = []
@@ -209,7 +590,8 @@ class TelegramBot(object):
         test_split = text.split()
         for msg in test_split:
             if validators.url(msg):
-                msg = await self.session.url_strict(msg)  # follow URL redirect, remove tracking code
+                with metrics.stage('url_strict'):
+                    msg = await self.session.url_strict(msg)  # follow URL redirect, remove tracking code
                 if self.url_pattern.match(msg):
                     urls.append(msg)
 
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import time
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+class ChatUpdateProcessor(BaseUpdateProcessor):
+    """
+    Process updates of different chats concurrently, up to max_concurrent_updates,
+    while updates of the same chat are processed one by one in order.
+    At most max_queue updates are pending, wait_for_capacity() applies backpressure to the producer.
+    The semaphore of BaseUpdateProcessor admits max_queue updates, do_process_update() limits them
+    to max_concurrent_updates. A slot is taken after the chat lock, so an update waiting for an earlier update
+    of its chat doesn't hold one.
+    """
+
+    def __init__(self, max_concurrent_updates: int = 16, max_queue: int = 256):
+        super().__init__(max(max_queue, max_concurrent_updates))
+        self.concurrency = max_concurrent_updates
+        self.max_queue = max_queue
+        self._limiter = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._chat_locks = {}   # chat id -> [lock, number of updates using it]
+        self._capacity = asyncio.Event()
+        self._capacity.set()
+
+        self.pending = 0        # updates received and not finished, including running ones
+        self.running = 0
+        self.processed = 0
+        self.wait_time = 0.0    # total seconds updates waited before running
+        self.max_wait = 0.0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def wait_for_capacity(self):
+        """
+        Wait until the number of pending updates is below max_queue
+        """
+        while self.pending >= self.max_queue:
+            self._capacity.clear()
+            await self._capacity.wait()
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        chat_id = update.effective_chat.id if isinstance(update, Update) and update.effective_chat else None
+        received_at = time.monotonic()
+        self.pending += 1
+
+        entry = None
+        if chat_id is not None:
+            entry = self._chat_locks.setdefault(chat_id, [asyncio.Lock(), 0])
+            entry[1] += 1
+
+        try:
+            if entry is None:
+                async with self._limiter:
+                    await self._run(coroutine, received_at)
+            else:
+                async with entry[0], self._limiter:
+                    await self._run(coroutine, received_at)
+        finally:
+            if entry is not None:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._chat_locks[chat_id]
+            self.pending -= 1
+            if self.pending < self.max_queue:
+                self._capacity.set()
+
+    async def _run(self, coroutine, received_at: float):
+        wait = time.monotonic() - received_at
+        self.wait_time += wait
+        self.max_wait = max(self.max_wait, wait)
+        self.running += 1
+        try:
+            await coroutine
+        finally:
+            self.running -= 1
+            self.processed += 1
+
+    def stats(self) -> dict:
+        return {'max_concurrent': self.concurrency, 'max_queue': self.max_queue,
+                'pending': self.pending, 'running': self.running, 'queued': self.pending - self.running,
+                'processed': self.processed, 'chats': len(self._chat_locks),
+                'avg_wait': round(self.wait_time / self.processed, 4) if self.processed else 0.0,
+                'max_wait': round(self.max_wait, 4)}
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+
+from lib.logger import logger
+
+
+def get_rest_id(tweet: dict) -> str:
+    """
+    Get tweet id from a TweetResultByRestId response
+    :param tweet: {'data': {'tweetResult': {'result': {'rest_id': '123', ...}}}}
+    :return: tweet id, or empty string if not found
+    """
+    try:
+        result = tweet['data']['tweetResult']['result']
+    except (KeyError, TypeError):
+        return ''
+    if 'rest_id' not in result and 'tweet' in result:
+        result = result['tweet']
+    return str(result.get('rest_id', ''))
+
+
+class TweetBatcher:
+    """
+    Collect tweet ids requested within a short window, and fetch them with one call.
+    Every caller gets its own result, or the error of the batch it was in.
+    """
+
+    def __init__(self, fetch_func, window: float = 0.03, batch_size: int = 10):
+        """
+        :param fetch_func: async function(list of tweet ids) -> list of TweetResultByRestId responses
+        :param window: seconds to wait for more ids after the first one arrived
+        :param batch_size: flush immediately when this many ids are waiting
+        """
+        self.fetch_func = fetch_func
+        self.window = window
+        self.batch_size = max(batch_size, 1)
+
+        self._pending = {}      # tweet id -> list of futures waiting for it
+        self._flush_handle = None
+        self._tasks = set()
+
+        self.requests = 0       # number of get() calls
+        self.batches = 0        # number of fetch_func calls
+        self.tweets = 0         # number of tweet ids fetched
+        self.max_batch = 0
+        self.errors = 0
+
+    async def get(self, tweet_id) -> dict | None:
+        """
+        Get one tweet
+        :param tweet_id:
+        :return: TweetResultByRestId response, or None if tweet is not found
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.setdefault(str(tweet_id), []).append(future)
+        self.requests += 1
+
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.window, self.flush)
+
+        return await future
+
+    def flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._pending:
+            return
+
+        pending, self._pending = self._pending, {}
+        task = asyncio.ensure_future(self._fetch(pending))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _fetch(self, pending: dict):
+        tweet_ids = list(pending)
+        self.batches += 1
+        self.tweets += len(tweet_ids)
+        self.max_batch = max(self.max_batch, len(tweet_ids))
+        logger.debug(f'Fetching {len(tweet_ids)} tweets in one batch: {tweet_ids}')
+
+        try:
+            tweets = await self.fetch_func(tweet_ids) or []
+        except Exception as e:
+            self.errors += 1
+            for futures in pending.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            return
+
+        results = {}
+        unnamed = []    # positions of the responses without a tweet id, e.g. unavailable tweets
+        for i, tweet in enumerate(tweets):
+            rest_id = get_rest_id(tweet)
+            if rest_id:
+                results[rest_id] = tweet
+            else:
+                unnamed.append(i)
+        if len(tweets) == len(tweet_ids):
+            # responses are in request order
+            for i in unnamed:
+                results.setdefault(tweet_ids[i], tweets[i])
+
+        for tweet_id, futures in pending.items():
+            for future in futures:
+                if not future.done():
+                    future.set_result(results.get(tweet_id))
+
+    def stats(self) -> dict:
+        return {'window_ms': round(self.window * 1000), 'batch_size': self.batch_size,
+                'requests': self.requests, 'batches': self.batches, 'tweets': self.tweets,
+                'avg_batch': round(self.tweets / self.batches, 2) if self.batches else 0.0,
+                'max_batch': self.max_batch, 'errors': self.errors, 'pending': len(self._pending)}
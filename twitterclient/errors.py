@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+import re
+import time
+
+
+class RateLimitError(Exception):
+    """
+    Twitter rate limit exceeded
+    """
+
+    def __init__(self, message: str = 'Rate limit exceeded', reset_at: float = 0):
+        """
+        :param message:
+        :param reset_at: time.time() when the rate limit resets, 0 if unknown
+        """
+        super().__init__(message)
+        self.reset_at = reset_at
+
+    @property
+    def retry_after(self) -> float:
+        return max(self.reset_at - time.time(), 0) if self.reset_at else 0
+
+
+class PoolRateLimitError(RateLimitError):
+    """
+    Every scraper of the pool is rate limited, not only the one which was used
+    """
+
+
+_rate_limit_message = re.compile(r'\b429 Too Many Requests\b|Rate limit', re.IGNORECASE)
+
+
+def is_rate_limited(response) -> bool:
+    """
+    Check a TweetResultByRestId response or an exception for rate limit errors
+    :param response: response json or exception
+    :return:
+    """
+    if isinstance(response, BaseException):
+        status_code = getattr(getattr(response, 'response', None), 'status_code', None)
+        if status_code is None:
+            status_code = getattr(response, 'status_code', None)
+        if status_code is not None:
+            return status_code == 429
+        # a bare '429' may be part of a tweet id in the message
+        return _rate_limit_message.search(str(response)) is not None
+
+    if isinstance(response, dict):
+        for error in response.get('errors') or []:
+            if error.get('code') == 88 or 'Rate limit' in str(error.get('message', '')):
+                return True
+    return False
+
+
+class TweetNotFoundError(ValueError):
+    """
+    Tweet doesn't exist, is deleted or is not visible, retrying doesn't help
+    """
+
+
+class CircuitOpenError(Exception):
+    """
+    Too many recent failures, tweet fetching is paused
+    """
+
+    def __init__(self, message: str = 'Circuit breaker is open', retry_after: float = 0):
+        super().__init__(message)
+        self.retry_after = retry_after
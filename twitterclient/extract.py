@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+
+def extract_tweet(tweet: dict) -> dict:
+    """
+    Pull the fields used by TwitterClient out of a TweetResultByRestId response in one pass,
+    nothing else is copied, so the response can be dropped before the media are resolved
+    :param tweet: {'data': {'tweetResult': {'result': {...}}}}
+    :return: {'media': [{'type': 'photo', 'url': 'https://t.co/x', 'media_url_https': '...'},
+                        {'type': 'video', 'url': 'https://t.co/y', 'duration_millis': 1000,
+                         'variants': [{'url': '...', 'bitrate': 123235}, ...]}],
+              'name': '', 'screen_name': '',
+              'note_text': text of a long tweet or None, 'full_text': text or None}
+    :raise ValueError: the response has no tweet result
+    """
+    try:
+        result = tweet['data']['tweetResult']['result']
+    except (KeyError, TypeError) as e:
+        raise ValueError(f'Tweet result not found: {e}') from e
+    if 'legacy' not in result and 'tweet' in result:
+        result = result['tweet']    # TweetWithVisibilityResults
+
+    legacy = result.get('legacy') or {}
+    media_list = []
+    for media in (legacy.get('extended_entities') or {}).get('media') or []:
+        item = {'type': media.get('type'), 'url': media.get('url')}
+        if item['type'] == 'video':
+            video_info = media.get('video_info') or {}
+            item['duration_millis'] = video_info.get('duration_millis', 0)
+            item['variants'] = [{'url': variant.get('url'), 'bitrate': variant.get('bitrate')}
+                                for variant in video_info.get('variants') or []]
+        elif item['type'] == 'photo':
+            item['media_url_https'] = media.get('media_url_https')
+        else:
+            continue
+        media_list.append(item)
+
+    user = ((((result.get('core') or {}).get('user_results') or {}).get('result') or {}).get('legacy') or {})
+    note = (((result.get('note_tweet') or {}).get('note_tweet_results') or {}).get('result') or {})
+
+    return {'media': media_list, 'name': user.get('name', ''), 'screen_name': user.get('screen_name', ''),
+            'note_text': note.get('text'), 'full_text': legacy.get('full_text')}
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import json
+
+from twitter.constants import Operation
+from twitter.util import get_headers
+
+from lib.utils import Session
+from twitterclient.errors import RateLimitError, is_rate_limited
+
+
+class GraphQLFetcher:
+    """
+    Native async TweetResultByRestId fetcher on the HTTP/2 Session,
+    reuses auth headers and cookies of a twitter-api-client scraper.
+    """
+
+    def __init__(self, session: Session, api_base: str = 'https://twitter.com/i/api/graphql'):
+        self.session = session
+        self.api_base = api_base.rstrip('/')
+        self.requests = 0
+        self.errors = 0
+
+    @staticmethod
+    def build_headers(scraper) -> dict:
+        # like Scraper._process, a guest session keeps its guest token in the session headers, not in the cookies
+        if getattr(scraper, 'guest', False):
+            return dict(scraper.session.headers)
+        return get_headers(scraper.session)
+
+    async def tweet_by_id(self, scraper, tweet_id, headers: dict = None) -> dict:
+        """
+        Get one tweet
+        :param scraper: twitter.scraper.Scraper, source of the auth headers and cookies
+        :param tweet_id:
+        :param headers: prebuilt headers of the scraper
+        :return: TweetResultByRestId response
+        :raise RateLimitError:
+        """
+        keys, qid, name = Operation.TweetResultByRestId
+        params = {'variables': Operation.default_variables | {'tweetId': str(tweet_id)},
+                  'features': Operation.default_features}
+        params = {k: json.dumps(v) for k, v in params.items()}
+
+        self.requests += 1
+        resp = await self.session.get(f'{self.api_base}/{qid}/{name}', params=params,
+                                      headers=headers or self.build_headers(scraper))
+
+        reset_at = int(resp.headers.get('x-rate-limit-reset', 0) or 0)
+        if resp.status_code == 429:
+            self.errors += 1
+            raise RateLimitError(f'Tweet {tweet_id} rate limited', reset_at=reset_at)
+        resp.raise_for_status()
+
+        tweet = resp.json()
+        if is_rate_limited(tweet):
+            self.errors += 1
+            raise RateLimitError(f'Tweet {tweet_id} rate limited', reset_at=reset_at)
+        return tweet
+
+    async def tweets_by_id(self, scraper, tweet_ids: list) -> list[dict]:
+        """
+        Get tweets concurrently
+        :param scraper:
+        :param tweet_ids:
+        :return: TweetResultByRestId responses, in the same order as tweet_ids
+        :raise RateLimitError: if any of them is rate limited
+        """
+        headers = self.build_headers(scraper)
+        return list(await asyncio.gather(*[self.tweet_by_id(scraper, tweet_id, headers) for tweet_id in tweet_ids]))
+
+    def stats(self) -> dict:
+        return {'requests': self.requests, 'errors': self.errors}
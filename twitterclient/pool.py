@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import time
+from contextlib import contextmanager
+
+from lib.logger import logger
+from twitterclient.errors import PoolRateLimitError
+
+
+class PoolMember:
+    """
+    One Twitter identity (account, cookie or guest session) and its rate limit state
+    """
+
+    def __init__(self, name: str, scraper, kind: str):
+        """
+        :param name: name used in logs
+        :param scraper: twitter.scraper.Scraper
+        :param kind: 'credentials', 'cookie' or 'guest'
+        """
+        self.name = name
+        self.scraper = scraper
+        self.kind = kind
+        self.created_at = time.monotonic()
+        self.cooldown_until = 0.0   # time.time() when the member can be used again
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.rate_limited = 0
+
+    @property
+    def healthy(self) -> bool:
+        return time.time() >= self.cooldown_until
+
+    def stats(self) -> dict:
+        return {'name': self.name, 'kind': self.kind, 'healthy': self.healthy, 'in_flight': self.in_flight,
+                'requests': self.requests, 'errors': self.errors, 'rate_limited': self.rate_limited,
+                'cooldown': round(max(self.cooldown_until - time.time(), 0), 1)}
+
+
+class ScraperPool:
+    """
+    Pool of scrapers, requests go to the least loaded healthy member.
+    A rate limited member cools down until its limit resets, guest sessions are refreshed in the background.
+    With a shared store, cooldowns of accounts and cookies are shared by the worker processes.
+    """
+
+    store_sync_interval = 1     # seconds between reading cooldowns from the shared store
+
+    def __init__(self, members: list[PoolMember], guest_factory=None, cooldown: float = 900,
+                 guest_refresh_interval: float = 1800, store=None, executor=None):
+        """
+        :param members:
+        :param guest_factory: blocking function() -> Scraper, creates a new guest session
+        :param cooldown: seconds a rate limited member is not used, if the reset time is unknown
+        :param guest_refresh_interval: seconds before a guest session is replaced by a new one, 0 to disable
+        :param store: lib.store.SharedStore, or None
+        :param executor: executor of the blocking guest_factory calls, None for the default executor
+        """
+        self.members = members
+        self.guest_factory = guest_factory
+        self.cooldown = cooldown
+        self.guest_refresh_interval = guest_refresh_interval
+        self.store = store
+        self.executor = executor
+        self._store_synced_at = 0.0
+        self._sync_task = None
+        self._refresh_task = None
+
+    def __len__(self):
+        return len(self.members)
+
+    def start(self):
+        """
+        Start refreshing guest sessions in the background, it's safe to call it more than once
+        """
+        if self._refresh_task is None and self.guest_factory and self.guest_refresh_interval > 0 \
+                and any(member.kind == 'guest' for member in self.members):
+            self._refresh_task = asyncio.get_running_loop().create_task(self._refresh_guests())
+
+    async def stop(self):
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            self._refresh_task = None
+
+    def acquire(self) -> PoolMember:
+        """
+        :return: the least loaded healthy member
+        :raise PoolRateLimitError: every member is cooling down
+        """
+        if not self.members:
+            raise Exception('No Twitter scraper available')
+        self._sync_cooldowns()
+
+        healthy = [member for member in self.members if member.healthy]
+        if not healthy:
+            reset_at = min((member.cooldown_until for member in self.members), default=0)
+            raise PoolRateLimitError('All Twitter scrapers are rate limited', reset_at=reset_at)
+
+        return min(healthy, key=lambda member: (member.in_flight, member.requests))
+
+    @contextmanager
+    def member(self):
+        member = self.acquire()
+        member.in_flight += 1
+        member.requests += 1
+        try:
+            yield member
+        finally:
+            member.in_flight -= 1
+
+    def mark_rate_limited(self, member: PoolMember, reset_at: float = 0):
+        member.rate_limited += 1
+        member.cooldown_until = reset_at or time.time() + self.cooldown
+        if self.store is not None and member.kind != 'guest':
+            # guest sessions are per process, accounts and cookies are the same in every worker
+            self.store.set('cooldown', member.name, member.cooldown_until, member.cooldown_until - time.time())
+        logger.warning(f'Twitter scraper {member.name} is rate limited, '
+                       f'cooling down for {member.cooldown_until - time.time():.0f} seconds')
+
+    def _sync_cooldowns(self):
+        # cooldowns of the other workers are loaded in the background, acquire() never waits for the store
+        if self.store is None or time.monotonic() - self._store_synced_at < self.store_sync_interval \
+                or (self._sync_task is not None and not self._sync_task.done()):
+            return
+        self._store_synced_at = time.monotonic()
+        self._sync_task = asyncio.get_running_loop().create_task(self._load_cooldowns())
+
+    async def _load_cooldowns(self):
+        for member in self.members:
+            if member.kind == 'guest':
+                continue
+            cooldown_until = await self.store.get('cooldown', member.name)
+            if cooldown_until:
+                member.cooldown_until = max(member.cooldown_until, cooldown_until)
+
+    async def _refresh_guests(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(min(self.guest_refresh_interval, 60))
+            for i, member in enumerate(self.members):
+                if member.kind != 'guest':
+                    continue
+                if member.healthy and time.monotonic() - member.created_at < self.guest_refresh_interval:
+                    continue
+                try:
+                    scraper = await loop.run_in_executor(self.executor, self.guest_factory)
+                except Exception as e:
+                    logger.error(f'Failed to refresh Twitter guest session {member.name}: {e}')
+                    continue
+                self.members[i] = PoolMember(member.name, scraper, 'guest')
+                logger.info(f'Twitter guest session {member.name} refreshed')
+
+    def stats(self) -> list[dict]:
+        return [member.stats() for member in self.members]
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+import random
+import time
+
+from lib.logger import logger
+
+
+def backoff_delay(attempt: int, base: float = 1.0, max_delay: float = 10.0) -> float:
+    """
+    Exponential backoff with jitter
+    :param attempt: 1 for the first retry
+    :param base: delay of the first retry
+    :param max_delay:
+    :return: seconds to wait, between half and all of the exponential delay
+    """
+    delay = min(max_delay, base * 2 ** (attempt - 1))
+    return delay * random.uniform(0.5, 1.0)
+
+
+def tweet_status(tweet: dict | None) -> str:
+    """
+    Classify a TweetResultByRestId response
+    :param tweet:
+    :return: 'ok', 'empty' (not found, may be a temporary glitch of guest sessions)
+        or 'unavailable' (deleted, suspended or protected)
+    """
+    if not tweet:
+        return 'empty'
+    try:
+        result = tweet['data']['tweetResult']['result']
+    except (KeyError, TypeError):
+        return 'empty'
+    if result.get('__typename') in {'TweetUnavailable', 'TweetTombstone'}:
+        return 'unavailable'
+    return 'ok'
+
+
+class CircuitBreaker:
+    """
+    Shared circuit breaker of tweet fetching.
+    It opens after `threshold` consecutive failures, or until the rate limit resets,
+    then lets one trial request through, and closes again when the trial succeeds.
+    """
+
+    def __init__(self, threshold: int = 5, reset_timeout: float = 30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.open_until = 0.0
+        self.opened = 0         # number of times the breaker opened
+        self.rejected = 0       # requests rejected while open
+        self._trial_at = 0.0
+
+    @property
+    def retry_after(self) -> float:
+        return max(self.open_until - time.time(), 0)
+
+    def allow(self) -> bool:
+        now = time.time()
+        if self.state == 'closed':
+            return True
+        if self.state == 'open' and now >= self.open_until:
+            self.state = 'half_open'
+            self._trial_at = 0.0
+        if self.state == 'half_open' and now - self._trial_at >= self.reset_timeout:
+            # one trial at a time, a trial which never reported back is given up after reset_timeout
+            self._trial_at = now
+            return True
+
+        self.rejected += 1
+        return False
+
+    def record_success(self):
+        if self.state != 'closed':
+            logger.info('Circuit breaker closed')
+        self.state = 'closed'
+        self.failures = 0
+
+    def record_failure(self, reset_at: float = 0):
+        """
+        :param reset_at: time.time() when the rate limit resets, the breaker opens at least until then
+        """
+        self.failures += 1
+        if self.state == 'half_open' or self.failures >= self.threshold or reset_at:
+            self.open_until = max(time.time() + self.reset_timeout, reset_at)
+            if self.state != 'open':
+                self.opened += 1
+                logger.warning(f'Circuit breaker opened for {self.retry_after:.0f} seconds '
+                               f'after {self.failures} failures')
+            self.state = 'open'
+
+    def stats(self) -> dict:
+        return {'state': self.state, 'open': self.state != 'closed', 'failures': self.failures, 'opened': self.opened,
+                'rejected': self.rejected, 'retry_after': round(self.retry_after, 1)}
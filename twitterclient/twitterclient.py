@@ -2,35 +2,103 @@
 
 import json
 import os
-import shutil
 import re
 import asyncio
-from urllib.parse import urlparse
 
 from twitter.scraper import Scraper
 from twitter.util import init_session
 
-from lib.utils import Session
+from lib import metrics, trace
+from lib.cache import TTLCache
+from lib.executor import InstrumentedExecutor
+from lib.singleflight import SingleFlight
+from lib.store import get_store
+from twitterclient.batcher import TweetBatcher
+from twitterclient.errors import RateLimitError, PoolRateLimitError, TweetNotFoundError, CircuitOpenError, \
+    is_rate_limited
+from twitterclient.extract import extract_tweet
+from twitterclient.graphql import GraphQLFetcher
+from twitterclient.pool import PoolMember, ScraperPool
+from twitterclient.retry import CircuitBreaker, backoff_delay, tweet_status
+from lib.utils import get_session, MediaBuffer, MemoryBudget, run_io, env_bool, env_int, env_float, \
+    parse_content_range, preallocate
 from lib.logger import logger
+from lib.mediastore import MediaStore, original_name, remove_file
 
 
 class TwitterClient(object):
     def __init__(self, debug=False):
-        self.default_params = {'pbar': False, 'debug': 0, 'save': True}     # default params for twitter-api-scraper
+        # default params for twitter-api-scraper, responses are kept in memory instead of saved to data/{tweet_id}
+        self.default_params = {'pbar': False, 'debug': 0, 'save': False}
         self.image_type = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.avif'}
         self.media_type = {'.mp4', '.m4v', '.mov', '.avi', '.flv', '.mkv', '.webm'}
         self.audio_type = {'.m4a', '.mp3', '.flac', '.ogg'}
         self.size_limit = 1024**2 * 50      # Telegram bot API limit
+        self.url_photo_limit = 1024**2 * 5  # Telegram bot API limits of media sent by url
+        self.url_video_limit = 1024**2 * 20
+        self.video_size_margin = env_float('VIDEO_SIZE_MARGIN', 0.1)       # estimates close to the limit are probed
+        self.video_size_overhead = env_float('VIDEO_SIZE_OVERHEAD', 1.03)  # container overhead of the estimate
         self.pattern = r'(?:https:\/\/)?(?:www\.)?(?:twitter|x)\.com\/(?:#!\/)?@?(\w{1,15})\/status\/(\d{1,})'
         self.debug = debug
 
         self.current_dir = os.getcwd()
         self.temp_dir = os.path.join(self.current_dir, 'temp')
-        if not os.path.exists(self.temp_dir):
-            os.makedirs(self.temp_dir, exist_ok=True)
-
-        self.scraper = self.twitter_account()  # create scraper using session
-        self.session = Session()
+        # downloaded media are kept in temp/<pid>/ by url and reused, least recently used ones are removed over quota
+        self.media_store = MediaStore(self.temp_dir, quota=env_int('MEDIA_STORE_QUOTA', 512 * 1024**2))
+
+        # blocking scraper calls run in their own thread pool, not in the default executor
+        self.scraper_executor = InstrumentedExecutor(max_workers=env_int('SCRAPER_WORKERS', 4),
+                                                     thread_name_prefix='twigram-scraper')
+        # scrapers are created by start() in the background, logins and guest sessions are blocking network calls
+        self.scraper_pool = ScraperPool([], guest_factory=self._create_scraper_from_guest,
+                                        cooldown=env_float('SCRAPER_COOLDOWN', 900),
+                                        guest_refresh_interval=env_float('GUEST_REFRESH_INTERVAL', 1800),
+                                        store=get_store(), executor=self.scraper_executor)
+        self._warmup = None
+        self.session = get_session()
+        # parsed tweet results (images url, videos url, text), keyed by tweet id
+        self.tweet_cache = TTLCache(maxsize=env_int('TWEET_CACHE_SIZE', 1024),
+                                    ttl=env_float('TWEET_CACHE_TTL', 600),
+                                    store=get_store(), namespace='tweet')
+        # concurrent media downloads, per tweet and for the whole process
+        self.tweet_download_concurrency = env_int('TWEET_DOWNLOAD_CONCURRENCY', 4)
+        download_concurrency = env_int('DOWNLOAD_CONCURRENCY', 8)
+        self.download_semaphore = asyncio.Semaphore(download_concurrency)
+        # keep media in memory instead of writing them to temp/, large videos are spooled to anonymous files
+        self.stream_media = env_bool('STREAM_MEDIA')
+        self.spool_max_size = env_int('SPOOL_MAX_SIZE', 8 * 1024**2)
+        # bytes of media buffered in memory by all downloads, media are downloaded in chunks
+        self.memory_budget = MemoryBudget(env_int('MEMORY_BUDGET', 64 * 1024**2))
+        self.chunk_size = env_int('DOWNLOAD_CHUNK_SIZE', 256 * 1024)
+        # videos larger than the threshold are downloaded by parallel Range requests, 1 segment disables it
+        self.range_segments = env_int('RANGE_SEGMENTS', 4)
+        self.range_threshold = env_int('RANGE_THRESHOLD', 8 * 1024**2)
+        per_host = self.session.pool.per_host
+        if per_host > 0 and self.range_segments * download_concurrency > per_host:
+            # the first range holds its host slot while the other segments wait for theirs,
+            # with fewer slots than all segments of all downloads, every download could wait for the others
+            segments = max(per_host // max(download_concurrency, 1), 1)
+            logger.warning(f'RANGE_SEGMENTS={self.range_segments} with DOWNLOAD_CONCURRENCY={download_concurrency} '
+                           f'needs more than HTTP_PER_HOST={per_host} slots per host, using {segments} segments')
+            self.range_segments = segments
+        # concurrent downloads of the same tweet share one download, see release()
+        self.downloads = SingleFlight()
+        # fetch tweets natively on the HTTP/2 session, with auth headers and cookies of the scrapers
+        self.graphql = None
+        if env_bool('ASYNC_GRAPHQL'):
+            self.graphql = GraphQLFetcher(self.session, os.getenv('TWITTER_GRAPHQL_URL',
+                                                                  'https://twitter.com/i/api/graphql'))
+        # retry policy of get_tweet, and the circuit breaker shared by all requests
+        self.fetch_deadline = env_float('FETCH_DEADLINE', 30)
+        self.not_found_retries = env_int('NOT_FOUND_RETRIES', 2)
+        self.retry_base = env_float('RETRY_BASE', 1)
+        self.retry_max_delay = env_float('RETRY_MAX_DELAY', 10)
+        self.breaker_wait = env_bool('BREAKER_WAIT')
+        self.breaker = CircuitBreaker(threshold=env_int('BREAKER_THRESHOLD', 5),
+                                      reset_timeout=env_float('BREAKER_TIMEOUT', 30))
+        # tweet ids requested within the window are fetched by one scraper call
+        self.batcher = TweetBatcher(self.fetch_tweets, window=env_float('BATCH_WINDOW_MS', 30) / 1000,
+                                    batch_size=env_int('BATCH_SIZE', 10))
 
     def _create_scraper_from_credentials(self, email: str, username: str, password: str):
         """
@@ -65,58 +133,198 @@ class TwitterClient(object):
                 logger.error('Twitter cookie login failed: {}'.format(e))
         return None
 
-    def twitter_account(self) -> Scraper:
+    def _create_scraper_from_guest(self) -> Scraper:
+        """
+        Create scraper from guest session, no login required
+        :return: Twitter scraper
+        """
+        session = init_session()  # initialize guest session, it's a blocking network call
+        return Scraper(session=session, **self.default_params)
+
+    def start(self) -> asyncio.Task:
+        """
+        Create the scrapers in the background, it's safe to call it more than once
+        :return: the warmup task
+        """
+        if self._warmup is None:
+            self._warmup = asyncio.get_running_loop().create_task(self._start())
+            # nobody may wait for it, the error is logged by _start()
+            self._warmup.add_done_callback(lambda task: task.cancelled() or task.exception())
+        return self._warmup
+
+    async def _start(self):
+        loop = asyncio.get_running_loop()
+        try:
+            with metrics.stage('warmup'):
+                members = await loop.run_in_executor(self.scraper_executor, self.twitter_account)
+            if not members:
+                raise Exception('No Twitter scraper available')
+        except Exception as e:
+            logger.error(f'Failed to create Twitter scrapers, retry on next use: {e}')
+            self._warmup = None     # Twitter may be unreachable now
+            raise
+
+        self.scraper_pool.members.extend(members)
+        self.scraper_pool.start()
+        logger.info(f'Twitter scraper pool ready, {len(members)} scrapers')
+
+    async def wait_ready(self):
+        """
+        Wait for the scrapers, start creating them if it's not started yet
+        """
+        if not self.ready:
+            await asyncio.shield(self.start())
+
+    @property
+    def ready(self) -> bool:
+        return len(self.scraper_pool) > 0
+
+    async def stop(self):
+        if self._warmup is not None:
+            self._warmup.cancel()
+            self._warmup = None
+        await self.scraper_pool.stop()
+
+    def twitter_account(self) -> list[PoolMember]:
         """
-        Create scraper from Twitter credentials or cookies
+        Create scrapers from Twitter credentials, cookies and guest sessions, it's blocking
         Get credentials from environment variables
-        TWITTER_COOKIE: Please provide a json format cookie, like
+        TWITTER_COOKIE: Please provide a json format cookie, or a json list of cookies, like
             {"auth_token": "xxx", "ct0": "yyy"}
+            [{"auth_token": "xxx", "ct0": "yyy"}, {"auth_token": "zzz", "ct0": "www"}]
+        TWITTER_GUEST_SESSIONS: number of guest sessions, default is 1 if no credentials or cookies are provided,
+            otherwise 0
 
         If you don't provide any credentials, it will be created an anonymous session.
         But anonymous sessions may be flow-limited.
-        :return: Twitter scraper
+        :return: members of the scraper pool
         """
         twitter_username = os.getenv('TWITTER_USERNAME', '')
         twitter_email = os.getenv('TWITTER_EMAIL', '')
         twitter_password = os.getenv('TWITTER_PASSWORD', '')
         twitter_cookie = os.getenv('TWITTER_COOKIE', '')
+        members = []
 
         if twitter_username and twitter_email and twitter_password:
             scraper = self._create_scraper_from_credentials(twitter_email, twitter_username, twitter_password)
             if scraper:
                 logger.info('Twitter scraper created from credentials')
-                return scraper
+                members.append(PoolMember(twitter_username, scraper, 'credentials'))
 
         if twitter_cookie:
             try:
-                cookie = json.loads(twitter_cookie)
+                cookies = json.loads(twitter_cookie)
             except Exception as e:
                 logger.error('Twitter cookie format error: {}'.format(e))
             else:
-                if isinstance(cookie, dict):
-                    scraper = self._create_scraper_from_cookies(cookie)
-                    if scraper:
-                        logger.info('Twitter scraper created from cookie')
-                        return scraper
-
-        # at last, use guest session
-        session = init_session()  # initialize guest session, no login required
-        logger.info('Twitter scraper created from guest session')
-        return Scraper(session=session, **self.default_params)
+                if isinstance(cookies, dict):
+                    cookies = [cookies]
+                if isinstance(cookies, list):
+                    for i, cookie in enumerate(cookies):
+                        if not isinstance(cookie, dict):
+                            continue
+                        scraper = self._create_scraper_from_cookies(cookie)
+                        if scraper:
+                            logger.info(f'Twitter scraper created from cookie {i}')
+                            members.append(PoolMember(f'cookie-{i}', scraper, 'cookie'))
+
+        # at last, use guest sessions
+        guest_sessions = env_int('TWITTER_GUEST_SESSIONS', 0 if members else 1)
+        for i in range(guest_sessions):
+            try:
+                scraper = self._create_scraper_from_guest()
+            except Exception as e:
+                logger.error(f'Twitter guest session {i} failed: {e}')
+                continue
+            logger.info(f'Twitter scraper created from guest session {i}')
+            members.append(PoolMember(f'guest-{i}', scraper, 'guest'))
+
+        return members
 
-    async def download(self, tweet_url: str) -> tuple[list, list, str]:
+    async def download(self, tweet_url: str) -> tuple[list, list, str, int]:
         """
         Download images, videos and text from tweet url
+        Media are file paths, or MediaBuffer if self.stream_media is enabled.
+        Media which failed to download are left out, media_count tells if some of them are missing.
+        Concurrent downloads of the same tweet share the same files,
+        every call must be paired with release(tweet_id) after the files are used.
         :param tweet_url:
-        :return: images_path, videos_path, text
+        :return: images_path, videos_path, text, number of media of the tweet
         """
         tweet_id = self.get_tweet_id(tweet_url)
-        images_url, videos_url, text = await self.get_media_url(tweet_id)
-        images_path = await self.download_images(images_url, tweet_id)
-        videos_path = await self.download_videos(videos_url, tweet_id)
+        images_path, videos_path, text, media_count = await self.download_by_id(tweet_id)
 
         text = '{}\n\n{}'.format(text, tweet_url)
-        return images_path, videos_path, text
+        return images_path, videos_path, text, media_count
+
+    async def download_by_id(self, tweet_id: int) -> tuple[list, list, str, int]:
+        """
+        Same as download(), by tweet id, the text doesn't end with the tweet url
+        """
+        return await self.downloads.acquire(tweet_id, self._download, tweet_id)
+
+    async def _download(self, tweet_id: int) -> tuple[list, list, str, int]:
+        images_url, videos_url, text = await self.get_media_url(tweet_id)
+        semaphore = asyncio.Semaphore(self.tweet_download_concurrency)
+        images_path, videos_path = await asyncio.gather(self.download_images(images_url, tweet_id, semaphore),
+                                                        self.download_videos(videos_url, tweet_id, semaphore))
+
+        return images_path, videos_path, text, len(images_url) + len(videos_url)
+
+    async def release(self, tweet_id: int):
+        """
+        Release media of a tweet returned by download(), once no one else is using them
+        MediaBuffer are closed, files are left in the media store to be reused or evicted.
+        :param tweet_id:
+        :return:
+        """
+        result = self.downloads.release(tweet_id)
+        if result is None:
+            return
+
+        images_path, videos_path, _, _ = result
+        await self.release_media(images_path + videos_path)
+
+    async def release_media(self, media_list: list):
+        for media in media_list:
+            if isinstance(media, MediaBuffer):
+                await run_io(media.close)
+            else:
+                await self.media_store.unpin(media)
+
+    async def get_url_media(self, tweet_url: str) -> tuple[list[tuple[str, str]], str] | None:
+        """
+        Media of a tweet to be fetched by Telegram from their url, without downloading them
+        Sizes are probed concurrently, all of them must be under the url limits of Telegram.
+        :param tweet_url:
+        :return: ([(media type, url), ...], text), media type is 'photo' or 'video',
+            or None if the tweet has no media, or any of them is too large or its size is unknown
+        """
+        tweet_id = self.get_tweet_id(tweet_url)
+        images_url, videos_url, text = await self.get_media_url(tweet_id)
+        if not images_url and not videos_url:
+            return None
+
+        with metrics.stage('probe_media'):
+            sizes = await asyncio.gather(*[self.probe_media_size(url) for url in images_url + videos_url])
+        limits = [self.url_photo_limit] * len(images_url) + [self.url_video_limit] * len(videos_url)
+        if not all(0 < size <= limit for size, limit in zip(sizes, limits)):
+            logger.info(f'Tweet {tweet_id} media sizes {sizes} exceed url limits, download them')
+            return None
+
+        media = [('photo', url) for url in images_url] + [('video', url) for url in videos_url]
+        return media, '{}\n\n{}'.format(text, tweet_url)
+
+    async def get_text(self, tweet_url: str) -> str:
+        """
+        Get text from tweet url without downloading any media
+        :param tweet_url:
+        :return: text
+        """
+        tweet_id = self.get_tweet_id(tweet_url)
+        _, _, text = await self.get_media_url(tweet_id)
+
+        return '{}\n\n{}'.format(text, tweet_url)
 
     def get_tweet_id(self, url: str) -> int:
         """
@@ -132,65 +340,183 @@ class TwitterClient(object):
 
         return tweet_id
 
+    async def fetch_tweets(self, tweet_ids: list) -> list[dict]:
+        """
+        Fetch tweets by ids with the least loaded scraper of the pool.
+        With ASYNC_GRAPHQL enabled, it's fetched natively on the HTTP/2 session,
+        otherwise the blocking scraper call runs in self.scraper_executor.
+        Each call is one success or failure of the circuit breaker, however many callers wait for the batch.
+        A rate limited scraper is not a failure, the others can still be used, unless all of them are limited.
+        :param tweet_ids:
+        :return:
+        """
+        try:
+            tweets = await self._fetch_tweets(tweet_ids)
+        except PoolRateLimitError as e:
+            self.breaker.record_failure(e.reset_at)
+            raise
+        except RateLimitError:
+            raise
+        except Exception:
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+        return tweets
+
+    async def _fetch_tweets(self, tweet_ids: list) -> list[dict]:
+        await self.wait_ready()
+        loop = asyncio.get_running_loop()
+        with self.scraper_pool.member() as member:
+            try:
+                if self.graphql:
+                    tweets = await self.graphql.tweets_by_id(member.scraper, tweet_ids)
+                else:
+                    tweets = await loop.run_in_executor(self.scraper_executor, member.scraper.tweets_by_id,
+                                                        tweet_ids)
+            except RateLimitError as e:
+                member.errors += 1
+                self.scraper_pool.mark_rate_limited(member, e.reset_at)
+                raise
+            except Exception as e:
+                member.errors += 1
+                if is_rate_limited(e):
+                    self.scraper_pool.mark_rate_limited(member)
+                    raise RateLimitError(f'Twitter scraper {member.name} is rate limited: {e}') from e
+                raise
+
+            if any(is_rate_limited(tweet) for tweet in tweets or []):
+                member.errors += 1
+                self.scraper_pool.mark_rate_limited(member)
+                raise RateLimitError(f'Twitter scraper {member.name} is rate limited')
+
+        return tweets
+
     async def get_tweet(self, tweet_id: int) -> dict:
         """
         Get tweet info from tweet id
+        Not found tweets are retried a few times, deleted or protected ones are not retried.
+        Transient errors are retried with jittered exponential backoff, a rate limited scraper at once
+        on another one, or until the rate limit resets if all of them are limited, within self.fetch_deadline
+        seconds. While the circuit breaker is open, it fails fast, or waits for the breaker if BREAKER_WAIT is enabled.
         :param tweet_id:
         :return:
+        :raise TweetNotFoundError: tweet doesn't exist
+        :raise CircuitOpenError: too many recent failures
         """
         logger.info(f'Downloading tweet: {tweet_id}')
-        retries = 0
-        max_retries = 10
-
-        while retries < max_retries:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.fetch_deadline
+        attempt = 0
+        error = None
+
+        while True:
+            if not self.breaker.allow():
+                retry_after = self.breaker.retry_after
+                if not self.breaker_wait or loop.time() + retry_after > deadline:
+                    metrics.scraper_errors.inc(kind='circuit_open')
+                    raise CircuitOpenError(f'Fetching tweet {tweet_id} paused, circuit breaker is open',
+                                           retry_after=retry_after)
+                await asyncio.sleep(max(retry_after, 0.1))
+                continue
+
+            attempt += 1
             try:
-                loop = asyncio.get_event_loop()
-                tweets = await loop.run_in_executor(None, self.scraper.tweets_by_id, [tweet_id])
-
-                if tweets:
-                    return tweets[0]
-
-                # Tweet not found, log and retry
-                retries += 1
-                logger.info(f'Tweet {tweet_id} not found, retrying... ({retries}/{max_retries})')
-
+                tweet = await self.batcher.get(tweet_id)
+            except PoolRateLimitError as e:
+                metrics.scraper_errors.inc(kind='rate_limit')
+                error = e
+                delay = e.retry_after or backoff_delay(attempt, self.retry_base, self.retry_max_delay)
+                logger.info(f'Fetching tweet {tweet_id} rate limited on all scrapers: {e}, attempt {attempt}')
+            except RateLimitError as e:
+                # the scraper is cooling down now, retry at once on another one
+                metrics.scraper_errors.inc(kind='rate_limit')
+                error = e
+                delay = backoff_delay(attempt, self.retry_base / 10, self.retry_base)
+                logger.info(f'Fetching tweet {tweet_id} rate limited: {e}, attempt {attempt}')
             except Exception as e:
-                retries += 1
-                logger.info(f'Error fetching tweet {tweet_id}: {e}, retrying... ({retries}/{max_retries})')
-
-            # Wait with exponential backoff before retrying
-            await asyncio.sleep(2 * retries)
-
-        # After max retries, raise appropriate error
-        if tweets is not None and not tweets:
-            raise ValueError(f'Tweet {tweet_id} not found after {max_retries} attempts')
-        raise Exception(f'Failed to fetch tweet {tweet_id} after {max_retries} attempts')
+                metrics.scraper_errors.inc(kind='error')
+                error = e
+                delay = backoff_delay(attempt, self.retry_base, self.retry_max_delay)
+                logger.info(f'Error fetching tweet {tweet_id}: {e}, attempt {attempt}')
+            else:
+                status = tweet_status(tweet)
+                if status == 'ok':
+                    return tweet
+                metrics.scraper_errors.inc(kind=status)
+                if status == 'unavailable' or attempt > self.not_found_retries:
+                    raise TweetNotFoundError(f'Tweet {tweet_id} not found, {status}')
+                error = TweetNotFoundError(f'Tweet {tweet_id} not found')
+                delay = backoff_delay(attempt, self.retry_base, self.retry_max_delay)
+                logger.info(f'Tweet {tweet_id} not found, retrying... ({attempt}/{self.not_found_retries})')
+
+            if loop.time() + delay > deadline:
+                raise Exception(f'Failed to fetch tweet {tweet_id} after {attempt} attempts: {error}') from error
+            metrics.scraper_retries.inc()
+            await asyncio.sleep(delay)
+
+    def estimate_video_size(self, bitrate: int, duration_millis: int) -> int:
+        """
+        Estimate video size from bitrate and duration, with container overhead
+        :param bitrate: bits per second
+        :param duration_millis:
+        :return: size in bytes
+        """
+        return int(bitrate / 8 * duration_millis / 1000 * self.video_size_overhead)
 
-    async def get_largest_video(self, video_infos: list[dict]) -> str:
+    async def probe_media_size(self, media_url: str) -> int:
+        """
+        :param media_url:
+        :return: Content-Length of the media, 0 if it's unavailable
+        """
+        try:
+            resp = await self.session.head(media_url, timeout=self.session.probe_timeout)
+        except Exception as e:
+            logger.info(f'Media {media_url} probe failed: {e}')
+            return 0
+        if resp.status_code != 200:
+            logger.info(f'Media {media_url} status code {resp.status_code}')
+            return 0
+        return int(resp.headers.get('Content-Length', 0))
+
+    async def get_largest_video(self, video_infos: list[dict], duration_millis: int = 0) -> str:
         """
+        The size of each variant is estimated by bitrate x duration, no network call is needed
+        unless the estimate is too close to the limit, then the close variants are probed concurrently.
         :param video_infos: {'url': 'https://video.twimg.com/ext_tw_video/id/pu/vid/res/name.mp4', 'bitrate': 123235}
+            sorted by bitrate in descending order
+        :param duration_millis: video duration, 0 if it's unknown
         :return: url of the largest video and smaller than self.size_limit(Now it's 50MB)
         """
-        bitrate = 0
         video_url = ''
+        candidates = []     # variants whose estimated size is too close to the limit
 
-        for video_info in video_infos:
-            if bitrate <= video_info.get('bitrate', 0) <= self.size_limit:
-                video_url = video_info.get('url', '')                
-
-        if not video_url:
+        if duration_millis:
             for video_info in video_infos:
-                resp = await self.session.head(video_info['url'])
-                if resp.status_code == 200:
-                    content_length = int(resp.headers.get('Content-Length', 0))
-                    if bitrate < content_length <= self.size_limit:
-                        bitrate = content_length
-                        video_url = video_info['url']
-                        logger.info(f'Video {video_info["url"]} size {content_length} set as largest video')
-                    else:
-                        logger.info(f'Video {video_info["url"]} size {content_length} bytes is smaller than {bitrate} bytes')
+                estimate = self.estimate_video_size(video_info.get('bitrate', 0), duration_millis)
+                if estimate > self.size_limit * (1 + self.video_size_margin):
+                    logger.debug(f'Video {video_info["url"]} estimated size {estimate} bytes is too large')
+                elif estimate > self.size_limit * (1 - self.video_size_margin):
+                    candidates.append((video_info, estimate))
                 else:
-                    logger.info(f'Video {video_info["url"]} status code {resp.status_code}')
+                    video_url = video_info['url']    # the largest one safely under the limit
+                    logger.info(f'Video {video_url} estimated size {estimate} bytes set as largest video')
+                    break
+        else:
+            candidates = [(video_info, 0) for video_info in video_infos]
+
+        if candidates:
+            with metrics.stage('probe_video'):
+                sizes = await asyncio.gather(*[self.probe_media_size(video_info['url'])
+                                               for video_info, _ in candidates])
+            for (video_info, estimate), content_length in zip(candidates, sizes):
+                if estimate and content_length:
+                    logger.info(f'Video size estimate {estimate} bytes, actual {content_length} bytes, '
+                                f'ratio {content_length / estimate:.3f}')
+                if 0 < content_length <= self.size_limit:
+                    # candidates are sorted by bitrate, the first one fits is the largest
+                    video_url = video_info['url']
+                    logger.info(f'Video {video_url} size {content_length} set as largest video')
+                    break
 
         if video_url:
             logger.info(f'Largest video url: {video_url}')
@@ -199,11 +525,12 @@ class TwitterClient(object):
 
         return video_url
 
-    async def get_video_url(self, video_variants: dict) -> str:
+    async def get_video_url(self, video_variants: dict, duration_millis: int = 0) -> str:
         """
         Get video url from tweet info
         Get all the video variants and choose the largest one and smaller than self.size_limit(Now it's 50MB)
         :param video_variants:
+        :param duration_millis: video duration from video_info
         :return:
         """
         video_infos = []
@@ -217,59 +544,53 @@ class TwitterClient(object):
         video_infos = sorted(video_infos, key=lambda x: x['bitrate'], reverse=True)
         logger.debug(f'Sorted video infos: {video_infos}')
 
-        return await self.get_largest_video(video_infos)
+        return await self.get_largest_video(video_infos, duration_millis)
 
     async def get_media_url(self, tweet_id: int) -> tuple[list, list, str]:
         """
         Get image and video url from tweet id
+        Results are cached in self.tweet_cache, repeat lookups skip the scraper.
         :param tweet_id:
         :return:
         """
+        with metrics.stage('get_media_url', tweet_id=tweet_id):
+            return await self._get_media_url(tweet_id)
+
+    async def _get_media_url(self, tweet_id: int) -> tuple[list, list, str]:
+        cached = await self.tweet_cache.fetch(str(tweet_id))
+        if cached is not None:
+            logger.info(f'Tweet {tweet_id} found in cache, {self.tweet_cache.stats()}')
+            image_urls, video_urls, text = cached
+            return list(image_urls), list(video_urls), text
+
         image_urls, video_urls, remove_urls = [], [], []
         # remove_urls is the url of the image or video in the text, we will remove it later
         text, name, screen_name = '', '', ''
 
-        tweet = await self.get_tweet(tweet_id)
-        tweet_result = tweet['data']['tweetResult']['result']
-        if 'legacy' not in tweet_result and 'tweet' in tweet_result:
-            tweet_result = tweet_result['tweet']
-
-        if ('legacy' in tweet_result
-                and 'extended_entities' in tweet_result['legacy']
-                and 'media' in tweet_result['legacy']['extended_entities']):
-            for media in tweet_result['legacy']['extended_entities']['media']:
-                media_type = media['type']
-
-                if media_type == 'video':
-                    video_variants = media['video_info']['variants']
-                    video_url = await self.get_video_url(video_variants)
-                    if video_url:
-                        video_urls.append(video_url)
-                        if 'url' in media:
-                            remove_urls.append(media['url'])
-                elif media_type == 'photo':
-                    if 'media_url_https' in media:
-                        image_urls.append('{}?name=4096x4096'.format(media['media_url_https']))
-                    if 'url' in media:
-                        remove_urls.append(media['url'])
+        with metrics.stage('get_tweet', tweet_id=tweet_id):
+            # only the used fields are kept, the response is not held while videos are probed
+            tweet = extract_tweet(await self.get_tweet(tweet_id))
 
-        if ('core' in tweet_result
-                and 'user_results' in tweet_result['core']
-                and 'result' in tweet_result['core']['user_results']
-                and 'legacy' in tweet_result['core']['user_results']['result']):
-            user_results = tweet_result['core']['user_results']['result']['legacy']
-            if 'name' in user_results:
-                name = user_results['name']                 # name of the user who tweeted
-            if 'screen_name' in user_results:
-                screen_name = user_results['screen_name']   # screen name of the user who tweeted
-
-        if ('note_tweet' in tweet_result
-                and 'note_tweet_results' in tweet_result['note_tweet']
-                and 'result' in tweet_result['note_tweet']['note_tweet_results']
-                and 'text' in tweet_result['note_tweet']['note_tweet_results']['result']):
-            text = tweet_result['note_tweet']['note_tweet_results']['result']['text']
-        elif 'legacy' in tweet_result and 'full_text' in tweet_result['legacy']:
-            text = tweet_result['legacy']['full_text']
+        for media in tweet['media']:
+            if media['type'] == 'video':
+                video_url = await self.get_video_url(media['variants'], media['duration_millis'])
+                if video_url:
+                    video_urls.append(video_url)
+                    if media['url']:
+                        remove_urls.append(media['url'])
+            elif media['type'] == 'photo':
+                if media['media_url_https']:
+                    image_urls.append('{}?name=4096x4096'.format(media['media_url_https']))
+                if media['url']:
+                    remove_urls.append(media['url'])
+
+        name = tweet['name']                # name of the user who tweeted
+        screen_name = tweet['screen_name']  # screen name of the user who tweeted
+
+        if tweet['note_text'] is not None:
+            text = tweet['note_text']
+        elif tweet['full_text'] is not None:
+            text = tweet['full_text']
             media_number = len(image_urls) + len(video_urls)
             if media_number > 0 and len(remove_urls) > 0:
                 # if there are images or videos in the tweet, remove the url of the image or video in the text
@@ -278,14 +599,7 @@ class TwitterClient(object):
         if any([name, screen_name]):
             text = f'{name} ({screen_name})\n\n{text}'
 
-        tweet_data_dir = os.path.join(self.current_dir, 'data', str(tweet_id))
-        # if not debug mode, remove the tweet data directory
-        if (not self.debug) and os.path.exists(tweet_data_dir) and os.path.isdir(tweet_data_dir):
-            try:
-                shutil.rmtree(tweet_data_dir)
-            except Exception as e:
-                logger.error(f'Failed to remove tweet data directory: {e}')
-
+        self.tweet_cache.set(str(tweet_id), (tuple(image_urls), tuple(video_urls), text))
         return image_urls, video_urls, text
 
     @staticmethod
@@ -306,50 +620,207 @@ class TwitterClient(object):
 
         return text
 
-    async def download_images(self, images_urls: list[str], tweet_id: int = 0) -> list:
+    async def download_all(self, download_func, urls: list[str], tweet_id: int = 0,
+                           semaphore: asyncio.Semaphore = None) -> list:
+        """
+        Download urls concurrently, limited by the per tweet semaphore and self.download_semaphore
+        A failed item doesn't cancel the others, it's just missing in the result.
+        Media already in the media store are reused without downloading.
+        :param download_func: async function(url, filename) -> filename, MediaBuffer or None
+        :param urls:
+        :param tweet_id:
+        :param semaphore: per tweet semaphore
+        :return: downloaded media, in the same order as urls
+        """
+        semaphore = semaphore or asyncio.Semaphore(self.tweet_download_concurrency)
+        done = []   # media to release if the download is cancelled
+
+        async def limited(url: str):
+            media = await self.media_store.get(url)
+            if media is None:
+                async with semaphore, self.download_semaphore:
+                    media = await download_func(url, self.media_store.path_for(url))
+            if media:
+                done.append(media)
+            return media
+
+        try:
+            results = await asyncio.gather(*[limited(url) for url in urls], return_exceptions=True)
+        except BaseException:
+            await asyncio.shield(self.release_media(done))
+            raise
+
+        filename_list = []
+        for url, result in zip(urls, results):
+            if isinstance(result, BaseException):
+                logger.error(f'Failed to download {url}: {result}')
+            elif result:
+                filename_list.append(result)
+
+        return filename_list
+
+    async def save_response(self, resp, filename: str):
+        """
+        Save a streaming response in chunks, file I/O runs in the I/O thread pool
+        The file is written to a part file and committed to the media store when it's complete.
+        :param resp: httpx streaming response
+        :param filename: path in the media store
+        :return: filename, or MediaBuffer if self.stream_media is enabled
+        """
+        size = int(resp.headers.get('Content-Length', 0))
+        if self.stream_media:
+            buffer = MediaBuffer(original_name(filename), size, self.spool_max_size, self.temp_dir,
+                                 self.memory_budget)
+            try:
+                async for chunk in resp.aiter_bytes(self.chunk_size):
+                    metrics.downloaded_bytes.inc(len(chunk))
+                    trace.add('bytes', len(chunk))
+                    await run_io(buffer.write, chunk)
+            except BaseException:
+                await asyncio.shield(run_io(buffer.close))
+                raise
+            buffer.size = size or buffer.tell()
+            return buffer
+
+        part = self.media_store.part_path(filename)
+        reserved = await self.memory_budget.acquire(self.chunk_size)
+        try:
+            f = await run_io(open, part, 'wb')
+            try:
+                async for chunk in resp.aiter_bytes(self.chunk_size):
+                    metrics.downloaded_bytes.inc(len(chunk))
+                    trace.add('bytes', len(chunk))
+                    await run_io(f.write, chunk)
+            finally:
+                await asyncio.shield(run_io(f.close))
+            return await self.media_store.commit(part, filename)
+        except BaseException:
+            await asyncio.shield(run_io(remove_file, part))
+            raise
+        finally:
+            self.memory_budget.release(reserved)
+
+    async def download_ranged(self, url: str, filename: str) -> str:
+        """
+        Download a media by parallel Range requests into a preallocated part file
+        The first request asks for the first range_threshold bytes, if the server answers 206 with a larger total,
+        the rest is split into range_segments - 1 segments downloaded alongside it.
+        Otherwise it's a single stream: a 200 without range support, or the whole media in the first range.
+        :param url:
+        :param filename: path in the media store
+        :return: filename
+        """
+        headers = {'Range': f'bytes=0-{self.range_threshold - 1}'}
+        async with self.session.stream(method='GET', url=url, headers=headers,
+                                       timeout=self.session.media_timeout) as resp:
+            resp.raise_for_status()
+            content_range = parse_content_range(resp.headers.get('Content-Range'))
+            if resp.status_code != 206 or content_range is None or content_range[2] <= self.range_threshold:
+                return await self.save_response(resp, filename)
+
+            first, last, total = content_range   # the server may send less than asked
+            if first != 0:
+                raise ValueError(f'Unexpected first range of {url}: {resp.headers.get("Content-Range")}')
+            segments = self.split_ranges(last + 1, total, self.range_segments - 1)
+            logger.info(f'Downloading {url} in {len(segments) + 1} ranges, {total} bytes')
+            part = self.media_store.part_path(filename)
+            try:
+                await run_io(preallocate, part, total)
+                tasks = [asyncio.ensure_future(self.write_range(resp, part, 0, last + 1))]
+                tasks += [asyncio.ensure_future(self.download_range(url, part, start, end)) for start, end in segments]
+                try:
+                    await asyncio.gather(*tasks)
+                except BaseException:
+                    for task in tasks:
+                        task.cancel()   # one failed segment fails the media, don't wait for the others
+                    await asyncio.gather(*tasks, return_exceptions=True)
+                    raise
+                return await self.media_store.commit(part, filename)
+            except BaseException:
+                await asyncio.shield(run_io(remove_file, part))
+                raise
+
+    @staticmethod
+    def split_ranges(start: int, total: int, count: int) -> list[tuple[int, int]]:
+        """
+        :return: count (first byte, last byte) ranges of about the same size, from start to the end of total bytes
+        """
+        size = -(-(total - start) // max(count, 1))
+        return [(offset, min(offset + size, total) - 1) for offset in range(start, total, size)]
+
+    async def download_range(self, url: str, part: str, start: int, end: int):
+        headers = {'Range': f'bytes={start}-{end}'}
+        async with self.session.stream(method='GET', url=url, headers=headers,
+                                       timeout=self.session.media_timeout) as resp:
+            resp.raise_for_status()
+            content_range = parse_content_range(resp.headers.get('Content-Range'))
+            if resp.status_code != 206 or content_range is None or content_range[0] != start:
+                raise ValueError(f'Unexpected response to range {start}-{end} of {url}: {resp.status_code} '
+                                 f'{resp.headers.get("Content-Range")}')
+            await self.write_range(resp, part, start, end - start + 1)
+
+    async def write_range(self, resp, part: str, offset: int, length: int):
+        """
+        Write length bytes of a streaming response at offset of the part file, in its own file handle
+        """
+        written = 0
+        reserved = await self.memory_budget.acquire(self.chunk_size)
+        try:
+            f = await run_io(open, part, 'r+b')
+            try:
+                await run_io(f.seek, offset)
+                async for chunk in resp.aiter_bytes(self.chunk_size):
+                    chunk = chunk[:length - written]
+                    metrics.downloaded_bytes.inc(len(chunk))
+                    trace.add('bytes', len(chunk))
+                    await run_io(f.write, chunk)
+                    written += len(chunk)
+                    if written >= length:
+                        break
+            finally:
+                await asyncio.shield(run_io(f.close))
+        finally:
+            self.memory_budget.release(reserved)
+
+        if written != length:
+            raise ValueError(f'Incomplete range at {offset} of {part}: {written} of {length} bytes')
+
+    async def download_images(self, images_urls: list[str], tweet_id: int = 0,
+                              semaphore: asyncio.Semaphore = None) -> list:
         """
         Download images
         :param images_urls:
         :param tweet_id:
+        :param semaphore: per tweet semaphore
         :return:
         """
-        filename_list = []
-        length = len(images_urls)
-
-        for i in range(length):
-            image_url = images_urls[i]
+        async def download_image(image_url: str, filename: str):
             logger.info(f'Downloading image: {image_url}')
-            r = await self.session.get(image_url)
-            if r.status_code == 200:
-                filename = urlparse(image_url).path.split('/')[-1]
-                filename = '{}/{}_{}_{}'.format(self.temp_dir, tweet_id, i, filename)
-                with open(filename, 'wb') as f:
-                    f.write(r.content)
-                filename_list.append(filename)
-            else:
-                logger.error(f'Failed to download image: {image_url}')
+            async with self.session.stream(method='GET', url=image_url, timeout=self.session.media_timeout) as resp:
+                if resp.status_code == 200:
+                    return await self.save_response(resp, filename)
+                else:
+                    logger.error(f'Failed to download image: {image_url}')
 
-        return filename_list
+        with metrics.stage('download_images'):
+            return await self.download_all(download_image, images_urls, tweet_id, semaphore)
 
-    async def download_videos(self, video_urls: list, tweet_id: int = 0) -> list:
+    async def download_videos(self, video_urls: list, tweet_id: int = 0,
+                              semaphore: asyncio.Semaphore = None) -> list:
         """
         Download videos
         :param video_urls:
         :param tweet_id:
+        :param semaphore: per tweet semaphore
         :return:
         """
-        file_list = []
-        length = len(video_urls)
-
-        for i in range(length):
-            video_url = video_urls[i]
+        async def download_video(video_url: str, filename: str):
             logger.info(f'Downloading video: {video_url}')
-            async with self.session.stream(method='GET', url=video_url) as resp:
-                filename = urlparse(video_url).path.split('/')[-1]
-                filename = '{}/{}_{}_{}'.format(self.temp_dir, tweet_id, i, filename)
-                with open(filename, 'wb') as f:
-                    async for chunk in resp.aiter_bytes():
-                        f.write(chunk)
-                file_list.append(filename)
-
-        return file_list
+            if self.range_segments > 1 and self.range_threshold > 0 and not self.stream_media:
+                return await self.download_ranged(video_url, filename)
+            async with self.session.stream(method='GET', url=video_url, timeout=self.session.media_timeout) as resp:
+                resp.raise_for_status()
+                return await self.save_response(resp, filename)
+
+        with metrics.stage('download_videos'):
+            return await self.download_all(download_video, video_urls, tweet_id, semaphore)
@@ -1,29 +1,55 @@
 # -*- coding: utf-8 -*-
 
+import hmac
+import os
+
 from quart import Quart, Response, request, jsonify
 
 from telebot.bot import TelegramBot
+from lib import metrics
 from lib.logger import logger
+from lib.profiler import profiler
+from lib.utils import io_executor
 from lib.version import version
 
 bot = TelegramBot()
 token = bot.get_token()
+admin_token = os.environ.get('ADMIN_TOKEN', '')
 app = Quart(__name__)
 
 
+def register_metrics():
+    client = bot.client
+    metrics.register_stats('tweet_cache', client.tweet_cache.stats)
+    metrics.register_stats('file_id_cache', bot.file_ids.stats)
+    metrics.register_stats('redirect_cache', bot.session.redirect_cache.stats)
+    metrics.register_stats('http_pool', bot.session.pool.stats)
+    metrics.register_stats('batcher', client.batcher.stats)
+    metrics.register_stats('breaker', client.breaker.stats)
+    metrics.register_stats('scraper', client.scraper_pool.stats)
+    metrics.register_stats('downloads', client.downloads.stats)
+    metrics.register_stats('memory_budget', client.memory_budget.stats)
+    metrics.register_stats('media_store', client.media_store.stats)
+    metrics.register_stats('executor', client.scraper_executor.stats, executor='scraper')
+    metrics.register_stats('executor', io_executor.stats, executor='io')
+    metrics.register_stats('updates', bot.update_processor.stats)
+    metrics.register_stats('update_queue', lambda: {'size': bot.application.update_queue.qsize()})
+    if client.graphql:
+        metrics.register_stats('graphql', client.graphql.stats)
+
+
+register_metrics()
+
+
 @app.before_serving
 async def run_bot() -> None:
-    await bot.run()
-    if not bot.application.running:
-        logger.info('Initializing bot')
-        await bot.application.initialize()
-        await bot.application.start()
+    bot.start()     # in the background, Telegram and Twitter may be slow or unreachable
 
 
 @app.after_serving
 async def stop():
     logger.info('Stopping bot')
-    await bot.application.stop()
+    await bot.stop()
 
 
 @app.get('/')
@@ -31,16 +57,58 @@ async def stop():
 @app.get('/twigram/')
 @app.get('/health')
 async def hello() -> Response:
-    message = {'message': 'Bot works!', 'version': version}
+    # liveness, the worker is serving requests
+    message = {'message': 'Bot works!', 'version': version, 'ready': bot.ready}
     return jsonify(message)
 
 
+@app.get('/ready')
+async def ready() -> Response:
+    # readiness, Telegram is set up and Twitter scrapers are created
+    message = {'ready': bot.ready, 'telegram': bot.application.running, 'twitter': bot.client.ready}
+    return jsonify(message), 200 if bot.ready else 503
+
+
+@app.get('/metrics')
+async def metrics_endpoint() -> Response:
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@app.get('/admin/profile')
+async def admin_profile() -> Response:
+    """
+    Sample all threads for ?seconds=10 (max 120), every ?interval=0.005 seconds, return collapsed stacks
+    Authenticated by the header Authorization: Bearer <ADMIN_TOKEN>, disabled if ADMIN_TOKEN is not set.
+    """
+    if not admin_token:
+        return jsonify({'message': 'Not found'}), 404
+    authorization = request.headers.get('Authorization', '')
+    if not hmac.compare_digest(authorization.encode(), f'Bearer {admin_token}'.encode()):
+        return jsonify({'message': 'Forbidden'}), 403
+
+    try:
+        seconds = min(max(float(request.args.get('seconds', 10)), 0.1), 120)
+        interval = min(max(float(request.args.get('interval', 0.005)), 0.001), 1)
+    except ValueError:
+        return jsonify({'message': 'Bad request'}), 400
+
+    try:
+        stacks = await profiler.profile(seconds, interval)
+    except RuntimeError as e:
+        return jsonify({'message': str(e)}), 409
+    return Response(stacks, content_type='text/plain; charset=utf-8')
+
+
 @app.post('/twigram/{}/down'.format(token))
 async def twigram() -> Response:
-    await bot.task(request)
-    message = {'message': 'OK'}
+    if not bot.check_secret(request.headers.get('X-Telegram-Bot-Api-Secret-Token')):
+        return jsonify({'message': 'Forbidden'}), 403
 
-    return jsonify(message)
+    status = bot.ingest(await request.get_data())
+    messages = {200: 'OK', 400: 'Bad request', 429: 'Too many updates'}
+    message = {'message': messages.get(status, 'OK')}
+
+    return jsonify(message), status
 
 
 @app.get('/twigram/<path>')